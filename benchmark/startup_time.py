@@ -0,0 +1,121 @@
+"""Measures how long the servers take to import what they depend on.
+
+Each server is measured in a fresh interpreter with `python -X importtime`,
+so that nothing is already imported or cached in memory. The servers start
+serving at import, so their dependencies are imported instead of them.
+
+    python benchmark/startup_time.py --budget 3
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+import prettytable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER_IMPORTS = {
+    'database_server': [
+        'fastapi',
+        'uvicorn',
+        'qwen_agent.utils.utils',
+        'qwen_server.record_store',
+        'qwen_server.utils',
+    ],
+    'workstation_server': [
+        'gradio',
+        'qwen_agent.actions',
+        'qwen_agent.actions.function_calling',
+        'qwen_agent.llm',
+        'qwen_agent.memory',
+        'qwen_agent.tools',
+        'qwen_agent.tools.code_interpreter',
+        'qwen_agent.utils.utils',
+        'qwen_server.record_store',
+        'qwen_server.utils',
+    ],
+    'assistant_server': [
+        'gradio',
+        'qwen_agent.actions',
+        'qwen_agent.llm',
+        'qwen_agent.memory',
+        'qwen_agent.utils.utils',
+        'qwen_server.record_store',
+    ],
+}
+
+
+def measure(modules):
+    """Returns the total import time in seconds, and the time per module."""
+    env = dict(os.environ)
+    paths = [ROOT, env.get('PYTHONPATH', '')]
+    env['PYTHONPATH'] = os.pathsep.join(paths).rstrip(os.pathsep)
+    code = '; '.join(f'import {x}' for x in modules)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          cwd=ROOT,
+                          env=env,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    # Lines look like 'import time:   self [us] |  cumulative | imported package',
+    # where nested imports are indented under the module that imports them.
+    total, timings = 0, {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        cumulative = int(fields[1]) / 1e6
+        name = fields[2].rstrip()
+        if not name.startswith('  '):  # imported at the top level
+            total += cumulative
+        timings[name.strip()] = cumulative
+    return total, timings
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server',
+                        type=str,
+                        nargs='+',
+                        default=list(SERVER_IMPORTS),
+                        choices=list(SERVER_IMPORTS))
+    parser.add_argument('--budget',
+                        type=float,
+                        default=None,
+                        help='fail if a server takes longer (in seconds)')
+    parser.add_argument('--top',
+                        type=int,
+                        default=10,
+                        help='the number of slowest modules to list')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    over_budget = []
+    for server in args.server:
+        total, timings = measure(SERVER_IMPORTS[server])
+        table = prettytable.PrettyTable(['Module', 'Cumulative (s)'])
+        table.align['Module'] = 'l'
+        for name, t in sorted(timings.items(),
+                              key=lambda x: x[1],
+                              reverse=True)[:args.top]:
+            table.add_row([name, f'{t:.3f}'])
+        print(f'{server}: {total:.3f}s')
+        print(table)
+        if args.budget is not None and total > args.budget:
+            over_budget.append(server)
+
+    if over_budget:
+        print(f'Over the budget of {args.budget}s: {", ".join(over_budget)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
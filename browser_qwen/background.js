@@ -1,6 +1,14 @@
 var database;
 
-function send_data(msg){
+// How often, and after how long at least (in seconds), a message refused by a
+// busy database server is sent again. The wait doubles with every attempt, up
+// to MAX_RETRY_DELAY, which is below the ~30s after which Chrome may stop an
+// idle service worker along with its timers.
+const MAX_RETRIES = 8;
+const RETRY_DELAY = 2;
+const MAX_RETRY_DELAY = 25;
+
+function send_data(msg, attempt = 0){
     chrome.storage.local.get(['database_host'], function(result) {
         if (result.database_host) {
             console.log('database_host currently is ' + result.database_host);
@@ -15,7 +23,17 @@ function send_data(msg){
             },
             body: JSON.stringify(msg),
         })
-          .then((response) => response.json())
+          .then((response) => {
+            if (response.status == 429 && attempt < MAX_RETRIES) {
+              // The server is busy caching other pages, try again later.
+              var delay = Math.min(MAX_RETRY_DELAY, Math.max(
+                parseFloat(response.headers.get("Retry-After")) || 0,
+                RETRY_DELAY * Math.pow(2, attempt)));
+              console.log('database busy, retrying in ' + delay + 's');
+              setTimeout(() => send_data(msg, attempt + 1), delay * 1000);
+            }
+            return response.json();
+          })
           .then((data) => {
             console.log(data.result);
           });
@@ -1,12 +1,25 @@
-from .continue_writing import ContinueWriting
-from .expand_writing import ExpandWriting
-from .outline_writing import OutlineWriting
-from .react import ReAct
-from .retrieval_qa import RetrievalQA
-from .summarize import Summarize
-from .write_from_scratch import WriteFromScratch
+import importlib
+
+# The actions are imported on first access, e.g. `from qwen_agent.actions
+# import RetrievalQA` does not import the others.
+_ACTION_MODULES = {
+    'RetrievalQA': 'retrieval_qa',
+    'ContinueWriting': 'continue_writing',
+    'OutlineWriting': 'outline_writing',
+    'ExpandWriting': 'expand_writing',
+    'ReAct': 'react',
+    'WriteFromScratch': 'write_from_scratch',
+    'Summarize': 'summarize',
+}
 
 __all__ = [
     'RetrievalQA', 'ContinueWriting', 'OutlineWriting', 'ExpandWriting',
     'ReAct', 'WriteFromScratch', 'Summarize'
 ]
+
+
+def __getattr__(name):
+    if name in _ACTION_MODULES:
+        module = importlib.import_module(f'.{_ACTION_MODULES[name]}', __name__)
+        return getattr(module, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
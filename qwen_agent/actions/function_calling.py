@@ -1,8 +1,77 @@
-from typing import Dict, Iterator, List
+from typing import Dict, Iterator, List, Optional
 
 from qwen_agent.actions.base import Action
 from qwen_agent.actions.react import ReAct
-from qwen_agent.tools import call_plugin
+from qwen_agent.tools import call_plugins_stream, closing_streams
+
+
+def get_function_calls(rsp: Dict) -> List[Dict]:
+    """Returns the function calls of a model turn, as name and arguments.
+
+    Both a list of `tool_calls` and a single legacy `function_call` are
+    understood.
+    """
+    if rsp.get('tool_calls', None):
+        tool_calls = [
+            x for x in rsp['tool_calls']
+            if x.get('type', 'function') == 'function'
+        ]
+        return [{
+            'id': x.get('id'),
+            'name': x['function']['name'],
+            'arguments': x['function']['arguments'],
+        } for x in tool_calls]
+    if rsp.get('function_call', None):
+        return [{
+            'id': None,
+            'name': rsp['function_call']['name'],
+            'arguments': rsp['function_call']['arguments'],
+        }]
+    return []
+
+
+def function_call_message(rsp: Dict, calls: List[Dict]) -> Dict:
+    """The assistant message making the calls, in the format of the model."""
+    if rsp.get('tool_calls', None):
+        return {
+            'role':
+            'assistant',
+            'content':
+            rsp['content'],
+            'tool_calls': [{
+                'id': x['id'],
+                'type': 'function',
+                'function': {
+                    'name': x['name'],
+                    'arguments': x['arguments'],
+                },
+            } for x in calls],
+        }
+    return {
+        'role': 'assistant',
+        'content': rsp['content'],
+        'function_call': {
+            'name': calls[0]['name'],
+            'arguments': calls[0]['arguments'],
+        },
+    }
+
+
+def function_result_messages(rsp: Dict, calls: List[Dict],
+                             observations: List[str]) -> List[Dict]:
+    """The messages returning the results of the calls, in order."""
+    if rsp.get('tool_calls', None):
+        return [{
+            'role': 'tool',
+            'tool_call_id': x['id'],
+            'name': x['name'],
+            'content': obs,
+        } for x, obs in zip(calls, observations)]
+    return [{
+        'role': 'function',
+        'name': calls[0]['name'],
+        'content': observations[0],
+    }]
 
 
 class FunctionCalling(Action):
@@ -10,14 +79,16 @@ class FunctionCalling(Action):
     def _run(self,
              user_request,
              functions: List[Dict] = None,
-             lang: str = 'en') -> Iterator[str]:
+             lang: str = 'en',
+             session_id: Optional[str] = None) -> Iterator[str]:
         functions = functions or []
 
         if not self.llm.support_function_calling():
             return ReAct(llm=self.llm,
                          stream=self.stream).run(user_request,
                                                  functions=functions,
-                                                 lang=lang)
+                                                 lang=lang,
+                                                 session_id=session_id)
 
         messages = [{'role': 'user', 'content': user_request}]
         is_first_yield = True
@@ -30,32 +101,31 @@ class FunctionCalling(Action):
                 is_first_yield = False
             else:
                 yield '\n'
-            if rsp.get('function_call', None):
+            calls = get_function_calls(rsp)
+            if calls:
                 yield rsp['content']
-                yield '\nAction: ' + rsp['function_call']['name']
-                yield '\nAction Input:\n'
-                yield rsp['function_call']['arguments']
+                messages.append(function_call_message(rsp, calls))
 
-                bot_msg = {
-                    'role': 'assistant',
-                    'content': rsp['content'],
-                    'function_call': {
-                        'name': rsp['function_call']['name'],
-                        'arguments': rsp['function_call']['arguments'],
-                    },
-                }
-                messages.append(bot_msg)
-
-                obs = call_plugin(rsp['function_call']['name'],
-                                  rsp['function_call']['arguments'])
-                yield '\nObservation: ' + obs + '\n'
+                # All calls start at once, their observations are in order.
+                plugin_calls = [(x['name'], x['arguments']) for x in calls]
+                results = []
+                with closing_streams(
+                        call_plugins_stream(
+                            plugin_calls,
+                            session_id=session_id)) as observations:
+                    for call, observation in zip(calls, observations):
+                        yield '\nAction: ' + call['name']
+                        yield '\nAction Input:\n'
+                        yield call['arguments']
+                        yield '\nObservation: '
+                        obs = ''
+                        for chunk in observation:
+                            obs += chunk
+                            yield chunk
+                        yield '\n'
+                        results.append(obs)
 
-                fn_msg = {
-                    'role': 'function',
-                    'name': rsp['function_call']['name'],
-                    'content': obs,
-                }
-                messages.append(fn_msg)
+                messages.extend(function_result_messages(rsp, calls, results))
             else:
                 yield 'Thought: I now know the final answer.'
                 yield '\nFinal Answer: ' + rsp['content']
@@ -2,7 +2,7 @@ import json
 from typing import Dict, Iterator, List, Optional
 
 from qwen_agent.actions.base import Action
-from qwen_agent.tools import call_plugin
+from qwen_agent.tools import call_plugin_stream
 
 TOOL_DESC = """{name_for_model}: Call this tool to interact with the {name_for_human} API. What is the {name_for_human} API useful for? {description_for_model} Parameters: {parameters}"""
 
@@ -71,7 +71,8 @@ class ReAct(Action):
              user_request,
              functions: List[Dict] = None,
              history: Optional[List[Dict]] = None,
-             lang: str = 'en') -> Iterator[str]:
+             lang: str = 'en',
+             session_id: Optional[str] = None) -> Iterator[str]:
         functions = functions or []
         prompt = _build_react_instruction(user_request, functions)
 
@@ -99,9 +100,15 @@ class ReAct(Action):
                     output = '\n' + output
             yield output
             if action:
-                observation = call_plugin(action, action_input)
+                yield '\nObservation: '
+                observation = ''
+                for chunk in call_plugin_stream(action,
+                                                action_input,
+                                                session_id=session_id):
+                    observation += chunk
+                    yield chunk
+                yield '\nThought:'
                 observation = f'\nObservation: {observation}\nThought:'
-                yield observation
                 messages[-1]['content'] += output + observation
             else:
                 break
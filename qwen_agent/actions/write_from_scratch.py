@@ -1,4 +1,8 @@
+import queue
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List
 
 import json5
 
@@ -7,6 +11,9 @@ from qwen_agent.actions.expand_writing import ExpandWriting
 from qwen_agent.actions.outline_writing import OutlineWriting
 from qwen_agent.actions.summarize import Summarize
 
+# How many sections are expanded at the same time, 1 for one after another.
+EXPAND_CONCURRENCY = 4
+
 default_plan = """{"action1": "summarize", "action2": "outline", "action3": "expand"}"""
 
 
@@ -18,7 +25,11 @@ def is_roman_numeral(s):
 
 class WriteFromScratch(Action):
 
-    def _run(self, user_request, ref_doc, lang: str = 'en'):
+    def _run(self,
+             user_request,
+             ref_doc,
+             lang: str = 'en',
+             max_concurrency: int = EXPAND_CONCURRENCY):
         # plan
         yield '\n========================= \n'
         yield '> Use Default plans: \n'
@@ -58,27 +69,65 @@ class WriteFromScratch(Action):
                     if is_roman_numeral(x):
                         outline_list.append(x)
 
-                otl_num = len(outline_list)
-                for i, v in enumerate(outline_list):
-                    yield '\n# '
-                    text = ''
-                    index = i + 1
-                    capture = v.strip()
-                    capture_later = ''
-                    if i < otl_num - 1:
-                        capture_later = outline_list[i + 1].strip()
-                    exp_agent = ExpandWriting(llm=self.llm, stream=self.stream)
-                    res_exp = exp_agent.run(
-                        user_request=user_request,
-                        ref_doc=ref_doc,
-                        outline=outline,
-                        index=str(index),
-                        capture=capture,
-                        capture_later=capture_later,
-                        lang=lang,
-                    )
-                    for trunk in res_exp:
-                        text += trunk
-                        yield trunk
+                for trunk in self._expand_sections(user_request, ref_doc,
+                                                   outline, outline_list, lang,
+                                                   max_concurrency):
+                    yield trunk
             else:
                 pass
+
+    def _expand_sections(self, user_request, ref_doc, outline: str,
+                         outline_list: List[str], lang: str,
+                         max_concurrency: int) -> Iterator[str]:
+        """Expands the sections with up to `max_concurrency` LLM calls at once.
+
+        The output is still streamed in the order of the outline: the current
+        section is streamed as it is generated, while the sections after it
+        are buffered until it is done.
+        """
+        otl_num = len(outline_list)
+        buffers = [queue.Queue() for _ in outline_list]
+        stopped = threading.Event()
+
+        def _expand(i: int):
+            try:
+                capture = outline_list[i].strip()
+                capture_later = ''
+                if i < otl_num - 1:
+                    capture_later = outline_list[i + 1].strip()
+                exp_agent = ExpandWriting(llm=self.llm, stream=self.stream)
+                res_exp = exp_agent.run(
+                    user_request=user_request,
+                    ref_doc=ref_doc,
+                    outline=outline,
+                    index=str(i + 1),
+                    capture=capture,
+                    capture_later=capture_later,
+                    lang=lang,
+                )
+                for trunk in res_exp:
+                    if stopped.is_set():
+                        break
+                    buffers[i].put(trunk)
+            except Exception as e:
+                buffers[i].put(e)
+            buffers[i].put(None)
+
+        executor = ThreadPoolExecutor(max_workers=max(max_concurrency, 1))
+        futures = [executor.submit(_expand, i) for i in range(otl_num)]
+        try:
+            for i in range(otl_num):
+                yield '\n# '
+                while True:
+                    trunk = buffers[i].get()
+                    if trunk is None:
+                        break
+                    if isinstance(trunk, Exception):
+                        raise trunk
+                    yield trunk
+        finally:
+            # Also reached if the consumer stops early.
+            stopped.set()
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
@@ -1,14 +1,57 @@
+import importlib
+from typing import List, Optional, Union
+
 from .base import BaseChatModel
-from .qwen_dashscope import QwenChatAtDS
-from .qwen_oai import QwenChatAsOAI
+from .cache import CachedChatModel
+from .load_balancer import LoadBalancedChatModel
+
+# The backends are imported on first access, along with their SDK.
+_BACKEND_MODULES = {
+    'QwenChatAtDS': 'qwen_dashscope',
+    'QwenChatAsOAI': 'qwen_oai',
+}
+
+
+def __getattr__(name):
+    if name in _BACKEND_MODULES:
+        module = importlib.import_module(f'.{_BACKEND_MODULES[name]}',
+                                         __name__)
+        return getattr(module, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
-def get_chat_model(model: str, api_key: str,
-                   model_server: str) -> BaseChatModel:
-    if model_server.strip().lower() == 'dashscope':
+def get_chat_model(model: str,
+                   api_key: str,
+                   model_server: Union[str, List[str]],
+                   routing: str = 'round_robin',
+                   cache_file: Optional[str] = None,
+                   cache_ttl: Optional[float] = None) -> BaseChatModel:
+    """Returns the chat model served by `model_server`.
+
+    `model_server` may also list several OpenAI-compatible servers, either as
+    a list or comma-separated. The requests are then load-balanced over them
+    by `routing`, which is `round_robin` or `least_outstanding`.
+    If `cache_file` is given, repeated requests are answered from a cache
+    persisted there, whose entries expire after `cache_ttl` seconds.
+    """
+    if isinstance(model_server, str):
+        model_server = model_server.split(',')
+    model_server = [x.strip() for x in model_server if x.strip()]
+    if len(model_server) == 1 and model_server[0].lower() == 'dashscope':
+        from .qwen_dashscope import QwenChatAtDS
         llm = QwenChatAtDS(model=model, api_key=api_key)
-    else:
+    elif len(model_server) == 1:
+        from .qwen_oai import QwenChatAsOAI
         llm = QwenChatAsOAI(model=model,
                             api_key=api_key,
-                            model_server=model_server)
+                            model_server=model_server[0])
+    else:
+        from .qwen_oai import QwenChatAsOAI
+        replicas = [
+            QwenChatAsOAI(model=model, api_key=api_key, model_server=x)
+            for x in model_server
+        ]
+        llm = LoadBalancedChatModel(replicas, routing=routing)
+    if cache_file:
+        llm = CachedChatModel(llm, cache_file=cache_file, ttl=cache_ttl)
     return llm
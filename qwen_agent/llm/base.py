@@ -1,6 +1,8 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import Dict, Iterator, List, Optional, Union
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Union
 
+from qwen_agent.llm.capabilities import CAPABILITIES, FUNCTION_CALLING
 from qwen_agent.log import logger
 from qwen_agent.utils.utils import print_traceback
 
@@ -9,6 +11,14 @@ class FnCallNotImplError(NotImplementedError):
     pass
 
 
+class ErrorText(str):
+    """The text that a failed call returns or streams instead of raising.
+
+    It is shown like any other text, but can be told apart from an answer,
+    e.g. so that it is not cached.
+    """
+
+
 class BaseChatModel(ABC):
 
     def __init__(self):
@@ -28,18 +38,54 @@ class BaseChatModel(ABC):
         stop: Optional[List[str]] = None,
         stream: bool = False,
     ) -> Union[str, Iterator[str]]:
-        if messages is None:
-            assert isinstance(prompt, str)
-            messages = [{'role': 'user', 'content': prompt}]
-        else:
-            assert prompt is None, 'Do not pass prompt and messages at the same time.'
-        logger.debug(messages)
+        messages = self._to_messages(prompt, messages)
         if stream:
             return self._chat_stream(messages, stop=stop)
         else:
             return self._chat_no_stream(messages, stop=stop)
 
+    # The async counterparts of chat() and chat_with_functions(). Backends that
+    # talk HTTP implement them natively on a shared connection pool, while
+    # the others fall back to running the sync methods in a worker thread.
+    async def achat(
+        self,
+        prompt: Optional[str] = None,
+        messages: Optional[List[Dict]] = None,
+        stop: Optional[List[str]] = None,
+    ) -> str:
+        messages = self._to_messages(prompt, messages)
+        return await self._achat_no_stream(messages, stop=stop)
+
+    def astream(
+        self,
+        prompt: Optional[str] = None,
+        messages: Optional[List[Dict]] = None,
+        stop: Optional[List[str]] = None,
+    ) -> AsyncIterator[str]:
+        messages = self._to_messages(prompt, messages)
+        return self._achat_stream(messages, stop=stop)
+
+    async def achat_with_functions(
+            self,
+            messages: List[Dict],
+            functions: Optional[List[Dict]] = None) -> Dict:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.chat_with_functions,
+                                          messages, functions)
+
+    @property
+    def capability_key(self) -> str:
+        """Identifies the model, and the server serving it, to CAPABILITIES."""
+        return type(self).__name__
+
+    def declare_capabilities(self, capabilities: Dict[str, bool]):
+        """Declares capabilities, e.g. from the config, instead of probing."""
+        CAPABILITIES.declare(self.capability_key, capabilities)
+
     def support_function_calling(self) -> bool:
+        if self._support_fn_call is None:
+            self._support_fn_call = CAPABILITIES.get(self.capability_key,
+                                                     FUNCTION_CALLING)
         if self._support_fn_call is None:
             functions = [{
                 'name': 'get_current_weather',
@@ -69,12 +115,16 @@ class BaseChatModel(ABC):
             try:
                 response = self.chat_with_functions(messages=messages,
                                                     functions=functions)
-                if response.get('function_call', None):
+                if response.get('function_call', None) or response.get(
+                        'tool_calls', None):
                     logger.info('Support of function calling is detected.')
                     self._support_fn_call = True
+                CAPABILITIES.set(self.capability_key, FUNCTION_CALLING,
+                                 self._support_fn_call)
             except FnCallNotImplError:
-                pass
+                CAPABILITIES.set(self.capability_key, FUNCTION_CALLING, False)
             except Exception:  # TODO: more specific
+                # Possibly transient, so not persisted.
                 print_traceback()
         return self._support_fn_call
 
@@ -98,3 +148,37 @@ class BaseChatModel(ABC):
         stop: Optional[List[str]] = None,
     ) -> str:
         raise NotImplementedError
+
+    async def _achat_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        response = self._chat_stream(messages, stop=stop)
+        sentinel = object()
+        while True:
+            chunk = await loop.run_in_executor(None, next, response, sentinel)
+            if chunk is sentinel:
+                break
+            yield chunk
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._chat_no_stream, messages,
+                                          stop)
+
+    @staticmethod
+    def _to_messages(prompt: Optional[str],
+                     messages: Optional[List[Dict]]) -> List[Dict]:
+        if messages is None:
+            assert isinstance(prompt, str)
+            messages = [{'role': 'user', 'content': prompt}]
+        else:
+            assert prompt is None, 'Do not pass prompt and messages at the same time.'
+        logger.debug(messages)
+        return messages
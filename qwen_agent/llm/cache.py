@@ -0,0 +1,243 @@
+import contextvars
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+from qwen_agent.llm.base import BaseChatModel, ErrorText
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+
+class CachedChatModel(BaseChatModel):
+    """Serves repeated requests to a chat model from a cache.
+
+    A request is keyed by a hash of the model, the messages, the stop words
+    and the functions. Responses are kept in an in-memory LRU tier of
+    `max_entries`, backed by a sqlite file if `cache_file` is given, and
+    expire after `ttl` seconds unless `ttl` is None. A streamed response is
+    stored as its chunks and replayed chunk by chunk; it also answers the
+    same request made without streaming, and vice versa.
+    """
+
+    def __init__(self,
+                 llm: BaseChatModel,
+                 cache_file: Optional[str] = None,
+                 max_entries: int = 1024,
+                 ttl: Optional[float] = None):
+        super().__init__()
+        self.llm = llm
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        # None, or whether to refresh the cache while bypassing it. In the
+        # context rather than thread-local, so that it follows a request into
+        # the threads and tasks that serve it.
+        self._bypass: contextvars.ContextVar = contextvars.ContextVar(
+            f'bypass_{id(self)}', default=None)
+        self._db: Optional[sqlite3.Connection] = None
+        if cache_file:
+            self._db = sqlite3.connect(cache_file,
+                                       timeout=30,
+                                       check_same_thread=False)
+            self._db.executescript(_SCHEMA)
+
+    @property
+    def capability_key(self) -> str:
+        return self.llm.capability_key
+
+    @contextmanager
+    def bypass(self, refresh: bool = True):
+        """Sends the requests made within to the model, even if cached.
+
+        With `refresh`, their responses replace the cached ones.
+        """
+        # Restored rather than reset, which would fail if a generator that
+        # entered this is resumed in another context, as Gradio does.
+        previous = self._bypass.get()
+        self._bypass.set(refresh)
+        try:
+            yield
+        finally:
+            self._bypass.set(previous)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute('DELETE FROM responses')
+
+    def chat_with_functions(self,
+                            messages: List[Dict],
+                            functions: Optional[List[Dict]] = None) -> Dict:
+        key = self._key('fn', messages, functions=functions)
+        value = self._get(key)
+        if value is None:
+            rsp = self.llm.chat_with_functions(messages, functions)
+            value = {'message': _to_dict(rsp)}
+            self._put(key, value)
+        return value['message']
+
+    async def achat_with_functions(
+            self,
+            messages: List[Dict],
+            functions: Optional[List[Dict]] = None) -> Dict:
+        key = self._key('fn', messages, functions=functions)
+        value = self._get(key)
+        if value is None:
+            rsp = await self.llm.achat_with_functions(messages, functions)
+            value = {'message': _to_dict(rsp)}
+            self._put(key, value)
+        return value['message']
+
+    def _chat_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> Iterator[str]:
+        key = self._key('chat', messages, stop=stop)
+        value = self._get(key)
+        if value is not None:
+            yield from value['chunks']
+            return
+        chunks = []
+        for chunk in self.llm._chat_stream(messages, stop=stop):
+            chunks.append(chunk)
+            yield chunk
+        # Only reached if the stream was consumed to the end.
+        self._put_chunks(key, chunks)
+
+    def _chat_no_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> str:
+        key = self._key('chat', messages, stop=stop)
+        value = self._get(key)
+        if value is not None:
+            return ''.join(value['chunks'])
+        text = self.llm._chat_no_stream(messages, stop=stop)
+        self._put_chunks(key, [text])
+        return text
+
+    async def _achat_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> AsyncIterator[str]:
+        key = self._key('chat', messages, stop=stop)
+        value = self._get(key)
+        if value is not None:
+            for chunk in value['chunks']:
+                yield chunk
+            return
+        chunks = []
+        async for chunk in self.llm._achat_stream(messages, stop=stop):
+            chunks.append(chunk)
+            yield chunk
+        self._put_chunks(key, chunks)
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> str:
+        key = self._key('chat', messages, stop=stop)
+        value = self._get(key)
+        if value is not None:
+            return ''.join(value['chunks'])
+        text = await self.llm._achat_no_stream(messages, stop=stop)
+        self._put_chunks(key, [text])
+        return text
+
+    def _key(self,
+             kind: str,
+             messages: List[Dict],
+             stop: Optional[List[str]] = None,
+             functions: Optional[List[Dict]] = None) -> str:
+        request = {
+            'model': self.capability_key,
+            'kind': kind,
+            'messages': messages,
+            'stop': stop or [],
+            'functions': functions or [],
+        }
+        request = json.dumps(request,
+                             ensure_ascii=False,
+                             sort_keys=True,
+                             separators=(',', ':'))
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def _get(self, key: str) -> Optional[Dict]:
+        if self._bypass.get() is not None:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None and self._db is not None:
+                row = self._db.execute(
+                    'SELECT created, value FROM responses WHERE key = ?',
+                    (key, )).fetchone()
+                if row is not None:
+                    entry = (row[0], json.loads(row[1]))
+            if entry is None:
+                return None
+            if self.ttl is not None and entry[0] + self.ttl < now:
+                self._delete(key)
+                return None
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            self._evict()
+            return entry[1]
+
+    def _put_chunks(self, key: str, chunks: List[str]):
+        # Failed calls come back as error messages instead of exceptions,
+        # possibly after part of the answer.
+        if any(isinstance(x, ErrorText) for x in chunks):
+            return
+        self._put(key, {'chunks': chunks})
+
+    def _put(self, key: str, value: Dict):
+        if self._bypass.get() is False:  # bypassed without refreshing
+            return
+        entry = (time.time(), value)
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            self._evict()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO responses (key, value, created) '
+                        'VALUES (?, ?, ?)',
+                        (key, json.dumps(value, ensure_ascii=False), entry[0]))
+
+    def _delete(self, key: str):
+        # Must hold self._lock.
+        self._memory.pop(key, None)
+        if self._db is not None:
+            with self._db:
+                self._db.execute('DELETE FROM responses WHERE key = ?',
+                                 (key, ))
+
+    def _evict(self):
+        # Must hold self._lock. Evicted entries stay in the sqlite tier.
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+
+def _to_dict(message) -> Dict:
+    # e.g. an OpenAIObject, which is a dict with nested OpenAIObjects
+    return json.loads(json.dumps(message, ensure_ascii=False))
@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+FUNCTION_CALLING = 'function_calling'
+
+# Detected capabilities are shared by all processes through this file.
+CAPABILITY_CACHE_FILE = os.getenv(
+    'QWEN_AGENT_CAPABILITY_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'qwen_agent',
+                 'capabilities.json'))
+CAPABILITY_TTL = float(
+    os.getenv('QWEN_AGENT_CAPABILITY_TTL', str(7 * 24 * 3600)))  # seconds
+
+
+class CapabilityRegistry:
+    """What each model, as served by a given server, is known to support.
+
+    A capability is either declared, e.g. in server_config.json, which is
+    final, or detected by probing the model. Detected capabilities are
+    persisted to `cache_file` and trusted for `ttl` seconds, so that other
+    processes and later runs need not probe again.
+    """
+
+    def __init__(self,
+                 cache_file: Optional[str] = CAPABILITY_CACHE_FILE,
+                 ttl: float = CAPABILITY_TTL):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self._declared: Dict[str, Dict[str, bool]] = {}
+        self._lock = threading.Lock()
+
+    def declare(self, key: str, capabilities: Dict[str, bool]):
+        with self._lock:
+            self._declared.setdefault(key, {}).update(capabilities)
+
+    def get(self, key: str, capability: str) -> Optional[bool]:
+        """Returns whether the capability is supported, None if unknown."""
+        with self._lock:
+            if capability in self._declared.get(key, {}):
+                return self._declared[key][capability]
+            entry = self._read().get(key, {}).get(capability)
+        if entry is None or entry['time'] + self.ttl < time.time():
+            return None
+        return entry['value']
+
+    def set(self, key: str, capability: str, value: bool):
+        """Records a detected capability."""
+        if not self.cache_file:
+            return
+        with self._lock:
+            data = self._read()
+            data.setdefault(key, {})[capability] = {
+                'value': value,
+                'time': time.time(),
+            }
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)),
+                        exist_ok=True)
+            tmp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as fp:
+                json.dump(data, fp, ensure_ascii=False)
+            os.replace(tmp_file, self.cache_file)
+
+    def _read(self) -> Dict:
+        if not (self.cache_file and os.path.exists(self.cache_file)):
+            return {}
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+
+CAPABILITIES = CapabilityRegistry()
@@ -0,0 +1,63 @@
+import asyncio
+import os
+import weakref
+from typing import Optional
+
+# Limits of the keep-alive connection pool shared by the async LLM clients.
+MAX_CONNECTIONS = int(os.getenv('QWEN_AGENT_LLM_MAX_CONNECTIONS', '100'))
+MAX_CONNECTIONS_PER_HOST = int(
+    os.getenv('QWEN_AGENT_LLM_MAX_CONNECTIONS_PER_HOST', '32'))
+KEEPALIVE_TIMEOUT = float(os.getenv('QWEN_AGENT_LLM_KEEPALIVE_TIMEOUT',
+                                    '30'))  # seconds
+READ_TIMEOUT = float(os.getenv('QWEN_AGENT_LLM_READ_TIMEOUT',
+                               '300'))  # seconds
+
+# aiohttp sessions are bound to the event loop they are created in.
+_SESSIONS: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+
+
+def configure(max_connections: Optional[int] = None,
+              max_connections_per_host: Optional[int] = None,
+              keepalive_timeout: Optional[float] = None,
+              read_timeout: Optional[float] = None):
+    """Changes the pool limits. Only affects sessions created afterwards."""
+    global MAX_CONNECTIONS, MAX_CONNECTIONS_PER_HOST, KEEPALIVE_TIMEOUT, READ_TIMEOUT
+    if max_connections is not None:
+        MAX_CONNECTIONS = max_connections
+    if max_connections_per_host is not None:
+        MAX_CONNECTIONS_PER_HOST = max_connections_per_host
+    if keepalive_timeout is not None:
+        KEEPALIVE_TIMEOUT = keepalive_timeout
+    if read_timeout is not None:
+        READ_TIMEOUT = read_timeout
+
+
+def get_session():
+    """Returns the aiohttp session of the running loop, creating it once.
+
+    All async LLM calls made on a loop share its session, and therefore its
+    keep-alive connections, instead of opening a connection per request.
+    """
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+    session = _SESSIONS.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=MAX_CONNECTIONS,
+            limit_per_host=MAX_CONNECTIONS_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=READ_TIMEOUT),
+        )
+        _SESSIONS[loop] = session
+    return session
+
+
+async def close_session():
+    """Closes the session of the running loop, e.g. on server shutdown."""
+    session = _SESSIONS.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
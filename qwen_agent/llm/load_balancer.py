@@ -0,0 +1,100 @@
+import itertools
+import threading
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+from qwen_agent.llm.base import BaseChatModel
+
+ROUND_ROBIN = 'round_robin'
+LEAST_OUTSTANDING = 'least_outstanding'
+
+
+class LoadBalancedChatModel(BaseChatModel):
+    """Spreads the requests over several replicas of the same model.
+
+    With `round_robin` routing the replicas take turns. With
+    `least_outstanding` routing a request goes to the replica with the fewest
+    requests in flight, which adapts to replicas of uneven speed. A streamed
+    request stays in flight until its stream is exhausted or closed.
+    """
+
+    def __init__(self,
+                 models: List[BaseChatModel],
+                 routing: str = ROUND_ROBIN):
+        super().__init__()
+        assert models, 'At least one model is required.'
+        if routing not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+            raise ValueError(f'Unknown routing: {routing}')
+        self.models = models
+        self.routing = routing
+        self._outstanding = [0] * len(models)
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def capability_key(self) -> str:
+        return '|'.join(sorted(x.capability_key for x in self.models))
+
+    def chat_with_functions(self,
+                            messages: List[Dict],
+                            functions: Optional[List[Dict]] = None) -> Dict:
+        with self._route() as model:
+            return model.chat_with_functions(messages, functions)
+
+    async def achat_with_functions(
+            self,
+            messages: List[Dict],
+            functions: Optional[List[Dict]] = None) -> Dict:
+        with self._route() as model:
+            return await model.achat_with_functions(messages, functions)
+
+    def _chat_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> Iterator[str]:
+        with self._route() as model:
+            yield from model._chat_stream(messages, stop=stop)
+
+    def _chat_no_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> str:
+        with self._route() as model:
+            return model._chat_no_stream(messages, stop=stop)
+
+    async def _achat_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> AsyncIterator[str]:
+        with self._route() as model:
+            async for chunk in model._achat_stream(messages, stop=stop):
+                yield chunk
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> str:
+        with self._route() as model:
+            return await model._achat_no_stream(messages, stop=stop)
+
+    @contextmanager
+    def _route(self) -> Iterator[BaseChatModel]:
+        with self._lock:
+            turn = next(self._turn)
+            n = len(self.models)
+            if self.routing == ROUND_ROBIN:
+                i = turn % n
+            else:
+                # Ties are broken by turn, so that idle replicas take turns.
+                i = min(((turn + k) % n for k in range(n)),
+                        key=lambda j: self._outstanding[j])
+            self._outstanding[i] += 1
+        try:
+            yield self.models[i]
+        finally:
+            with self._lock:
+                self._outstanding[i] -= 1
@@ -1,10 +1,64 @@
+import json
 import os
 from http import HTTPStatus
-from typing import Dict, Iterator, List, Optional
+from typing import AsyncIterator, Dict, Iterator, List, Optional
 
 import dashscope
 
-from qwen_agent.llm.base import BaseChatModel
+from qwen_agent.llm import http_pool
+from qwen_agent.llm.base import BaseChatModel, ErrorText
+
+
+class _StopWordHoldback:
+    """Releases streamed text as soon as no stop word can start in it.
+
+    Takes the deltas of the stream. Only a pending tail that is a prefix of
+    some stop word is held back, until the next delta shows whether the stop
+    word follows. The text from a complete stop word on is never released.
+    """
+
+    def __init__(self, stop: Optional[List[str]] = None):
+        self.stop = [word for word in (stop or []) if word]
+        self.prefixes = {
+            word[:i]
+            for word in self.stop for i in range(1, len(word))
+        }
+        self.max_prefix_len = max([len(x) for x in self.prefixes] or [0])
+        self.pending = ''
+        self.stopped = False
+
+    def feed(self, delta: str) -> str:
+        """Takes the next delta, returns the part that can be shown."""
+        if self.stopped:
+            return ''
+        text = self.pending + delta
+        cut = min([text.find(word) for word in self.stop if word in text]
+                  or [-1])
+        if cut >= 0:
+            self.stopped = True
+            self.pending = ''
+            return text[:cut]
+        hold = 0
+        for i in range(min(len(text), self.max_prefix_len), 0, -1):
+            if text[-i:] in self.prefixes:
+                hold = i
+                break
+        self.pending = text[len(text) - hold:]
+        return text[:len(text) - hold]
+
+    def reset(self):
+        self.pending = ''
+
+    def flush(self) -> str:
+        rest, self.pending = self.pending, ''
+        return rest
+
+
+def _format_stream_error(code: str, message: str) -> ErrorText:
+    err = '\nError code: %s. Error message: %s' % (code, message)
+    if code == 'DataInspectionFailed':
+        err += '\n错误码: 数据检查失败。错误信息: 输入数据可能包含不适当的内容。'
+    return ErrorText(err)
 
 
 class QwenChatAtDS(BaseChatModel):
@@ -15,6 +69,11 @@ class QwenChatAtDS(BaseChatModel):
         dashscope.api_key = api_key.strip() or os.getenv('DASHSCOPE_API_KEY',
                                                          default='')
         assert dashscope.api_key, 'DASHSCOPE_API_KEY is required.'
+        self.api_key = dashscope.api_key
+
+    @property
+    def capability_key(self) -> str:
+        return f'{self.model}@dashscope'
 
     def _chat_stream(
         self,
@@ -32,32 +91,21 @@ class QwenChatAtDS(BaseChatModel):
             top_p=0.8,
             result_format='message',
             stream=True,
+            incremental_output=True,  # deltas instead of the text so far
         )
-        last_len = 0
-        delay_len = 5
-        in_delay = False
-        text = ''
+        holdback = _StopWordHoldback(stop)
         for trunk in response:
             if trunk.status_code == HTTPStatus.OK:
-                text = trunk.output.choices[0].message.content
-                if (len(text) - last_len) <= delay_len:
-                    in_delay = True
-                    continue
-                else:
-                    in_delay = False
-                    real_text = text[:-delay_len]
-                    now_rsp = real_text[last_len:]
+                now_rsp = holdback.feed(
+                    trunk.output.choices[0].message.content)
+                if now_rsp:
                     yield now_rsp
-                    last_len = len(real_text)
             else:
-                err = '\nError code: %s. Error message: %s' % (trunk.code,
-                                                               trunk.message)
-                if trunk.code == 'DataInspectionFailed':
-                    err += '\n错误码: 数据检查失败。错误信息: 输入数据可能包含不适当的内容。'
-                text = ''
-                yield f'{err}'
-        if text and (in_delay or (last_len != len(text))):
-            yield text[last_len:]
+                holdback.reset()
+                yield _format_stream_error(trunk.code, trunk.message)
+        rest = holdback.flush()
+        if rest:
+            yield rest
 
     def _chat_no_stream(
         self,
@@ -83,4 +131,92 @@ class QwenChatAtDS(BaseChatModel):
                 response.code,
                 response.message,
             )
-            return err
+            return ErrorText(err)
+
+    async def _achat_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> AsyncIterator[str]:
+        holdback = _StopWordHoldback(stop)
+        async for data in self._apost(messages, stop=stop, stream=True):
+            if 'output' in data:
+                now_rsp = holdback.feed(
+                    data['output']['choices'][0]['message']['content'])
+                if now_rsp:
+                    yield now_rsp
+            else:
+                holdback.reset()
+                yield _format_stream_error(data.get('code'),
+                                           data.get('message'))
+        rest = holdback.flush()
+        if rest:
+            yield rest
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> str:
+        async for data in self._apost(messages, stop=stop, stream=False):
+            if 'output' in data:
+                return data['output']['choices'][0]['message']['content']
+            else:
+                err = 'Error code: %s, error message: %s' % (
+                    data.get('code'),
+                    data.get('message'),
+                )
+                return ErrorText(err)
+        return ''
+
+    async def _apost(self, messages: List[Dict], stop: Optional[List[str]],
+                     stream: bool) -> AsyncIterator[Dict]:
+        """Calls the HTTP API of DashScope on the shared connection pool.
+
+        Yields the response, or each server-sent event if streaming. Errors
+        come as dicts with a `code` and a `message` instead of an `output`.
+        """
+        stop = stop or []
+        url = dashscope.base_http_api_url.rstrip(
+            '/') + '/services/aigc/text-generation/generation'
+        headers = {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json',
+        }
+        payload = {
+            'model': self.model,
+            'input': {
+                'messages': messages
+            },
+            'parameters': {
+                'result_format':
+                'message',
+                'top_p':
+                0.8,
+                'stop_words': [{
+                    'stop_str': word,
+                    'mode': 'exclude'
+                } for word in stop],
+            },
+        }
+        if stream:
+            headers['Accept'] = 'text/event-stream'
+            headers['X-DashScope-SSE'] = 'enable'
+            payload['parameters']['incremental_output'] = True
+        session = http_pool.get_session()
+        async with session.post(url, headers=headers, json=payload) as resp:
+            if resp.status != HTTPStatus.OK or not stream:
+                try:
+                    yield await resp.json(content_type=None)
+                except ValueError:
+                    yield {'code': resp.status, 'message': await resp.text()}
+                return
+            # Not `async for line in resp.content`, whose lines are limited in
+            # length, which a long event could exceed.
+            buffer = b''
+            async for data in resp.content.iter_any():
+                *lines, buffer = (buffer + data).split(b'\n')
+                for line in lines:
+                    line = line.decode('utf-8').strip()
+                    if line.startswith('data:'):
+                        yield json.loads(line[len('data:'):])
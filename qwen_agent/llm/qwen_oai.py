@@ -1,28 +1,38 @@
-from typing import Dict, Iterator, List, Optional
+from typing import AsyncIterator, Dict, Iterator, List, Optional
 
 import openai
 
+from qwen_agent.llm import http_pool
 from qwen_agent.llm.base import BaseChatModel
 
 
+def _to_tools(functions: List[Dict]) -> List[Dict]:
+    # As tools rather than the legacy functions, so that the model may call
+    # several of them in one turn, in `tool_calls`.
+    return [{'type': 'function', 'function': x} for x in functions]
+
+
 class QwenChatAsOAI(BaseChatModel):
 
     def __init__(self, model: str, api_key: str, model_server: str):
         super().__init__()
         assert model_server.startswith('http')
-        openai.api_base = model_server
-        openai.api_key = api_key.strip() or 'EMPTY'
+        # Kept per instance and passed on every request, rather than set on
+        # the openai module, so that instances for several servers coexist.
         self.model = model
+        self.api_base = model_server
+        self.api_key = api_key.strip() or 'EMPTY'
+
+    @property
+    def capability_key(self) -> str:
+        return f'{self.model}@{self.api_base}'
 
     def _chat_stream(
         self,
         messages: List[Dict],
         stop: Optional[List[str]] = None,
     ) -> Iterator[str]:
-        response = openai.ChatCompletion.create(model=self.model,
-                                                messages=messages,
-                                                stop=stop,
-                                                stream=True)
+        response = self._create(messages=messages, stop=stop, stream=True)
         # TODO: error handling
         for chunk in response:
             if hasattr(chunk.choices[0].delta, 'content'):
@@ -33,10 +43,7 @@ class QwenChatAsOAI(BaseChatModel):
         messages: List[Dict],
         stop: Optional[List[str]] = None,
     ) -> str:
-        response = openai.ChatCompletion.create(model=self.model,
-                                                messages=messages,
-                                                stop=stop,
-                                                stream=False)
+        response = self._create(messages=messages, stop=stop, stream=False)
         # TODO: error handling
         return response.choices[0].message.content
 
@@ -44,11 +51,60 @@ class QwenChatAsOAI(BaseChatModel):
                             messages: List[Dict],
                             functions: Optional[List[Dict]] = None) -> Dict:
         if functions:
-            response = openai.ChatCompletion.create(model=self.model,
-                                                    messages=messages,
-                                                    functions=functions)
+            response = self._create(messages=messages,
+                                    tools=_to_tools(functions))
+        else:
+            response = self._create(messages=messages)
+        # TODO: error handling
+        return response.choices[0].message
+
+    async def _achat_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> AsyncIterator[str]:
+        response = await self._acreate(messages=messages,
+                                       stop=stop,
+                                       stream=True)
+        # TODO: error handling
+        async for chunk in response:
+            if hasattr(chunk.choices[0].delta, 'content'):
+                yield chunk.choices[0].delta.content
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Dict],
+        stop: Optional[List[str]] = None,
+    ) -> str:
+        response = await self._acreate(messages=messages,
+                                       stop=stop,
+                                       stream=False)
+        # TODO: error handling
+        return response.choices[0].message.content
+
+    async def achat_with_functions(
+            self,
+            messages: List[Dict],
+            functions: Optional[List[Dict]] = None) -> Dict:
+        if functions:
+            response = await self._acreate(messages=messages,
+                                           tools=_to_tools(functions))
         else:
-            response = openai.ChatCompletion.create(model=self.model,
-                                                    messages=messages)
+            response = await self._acreate(messages=messages)
         # TODO: error handling
         return response.choices[0].message
+
+    def _create(self, **kwargs):
+        return openai.ChatCompletion.create(model=self.model,
+                                            api_base=self.api_base,
+                                            api_key=self.api_key,
+                                            **kwargs)
+
+    async def _acreate(self, **kwargs):
+        # openai reuses the session set in the context instead of opening a
+        # new one per request; the context is local to the calling task.
+        openai.aiosession.set(http_pool.get_session())
+        return await openai.ChatCompletion.acreate(model=self.model,
+                                                   api_base=self.api_base,
+                                                   api_key=self.api_key,
+                                                   **kwargs)
@@ -1,3 +1,4 @@
+from .inverted_index import InvertedIndex
 from .memory import Memory
 
-__all__ = ['Memory']
+__all__ = ['Memory', 'InvertedIndex']
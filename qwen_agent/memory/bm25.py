@@ -0,0 +1,96 @@
+from collections import Counter
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from qwen_agent.memory.inverted_index import InvertedIndex
+
+
+class BM25:
+    """Okapi BM25 over all pages of an InvertedIndex (BM25+ if delta > 0).
+
+    The corpus statistics (page lengths, idf) and a term-major sparse matrix
+    of term frequencies are precomputed once per index version, so scoring a
+    query against every page is a handful of vectorized numpy operations.
+    """
+
+    def __init__(self,
+                 index: InvertedIndex,
+                 k1: float = 1.5,
+                 b: float = 0.75,
+                 delta: float = 0.0):
+        self.index = index
+        self.k1 = k1
+        self.b = b
+        self.delta = delta
+        self._version = -1
+        self._page_range: Dict[str, Tuple[int, int]] = {}
+        self._term_ids: Dict[str, int] = {}
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._page_ids = np.zeros(0, dtype=np.int64)
+        self._tfs = np.zeros(0, dtype=np.float32)
+        self._norm = np.zeros(0, dtype=np.float32)
+        self._idf = np.zeros(0, dtype=np.float32)
+
+    @property
+    def num_pages(self) -> int:
+        return len(self._norm)
+
+    def page_range(self, url: str) -> Tuple[int, int]:
+        """Returns the [start, end) slice of a document in the score vector."""
+        self.fit()
+        return self._page_range.get(url, (0, 0))
+
+    def get_scores(self, terms: List[str]) -> np.ndarray:
+        """Scores the query against every page of the corpus."""
+        self.fit()
+        ids, weights = [], []
+        for term, qtf in Counter(terms).items():
+            tid = self._term_ids.get(term)
+            if tid is None:
+                continue
+            lo, hi = self._indptr[tid], self._indptr[tid + 1]
+            page_ids = self._page_ids[lo:hi]
+            tfs = self._tfs[lo:hi]
+            tf_part = tfs * (self.k1 + 1) / (tfs + self._norm[page_ids])
+            ids.append(page_ids)
+            weights.append(qtf * self._idf[tid] * (tf_part + self.delta))
+        if not ids:
+            return np.zeros(self.num_pages, dtype=np.float32)
+        return np.bincount(np.concatenate(ids),
+                           weights=np.concatenate(weights),
+                           minlength=self.num_pages).astype(np.float32)
+
+    def fit(self):
+        if self._version == self.index.version:
+            return
+        page_len = []
+        page_range = {}
+        for url, pages in self.index.documents().items():
+            page_range[url] = (len(page_len), len(page_len) + len(pages))
+            page_len.extend(sum(terms.values()) for terms in pages)
+
+        # The postings are term-major already, i.e. a CSR matrix in disguise.
+        term_ids: Dict[str, int] = {}
+        indptr, cols, vals = [0], [], []
+        for term, docs in self.index.postings().items():
+            term_ids[term] = len(term_ids)
+            for url, tfs in docs.items():
+                start = page_range[url][0]
+                cols.extend(start + i for i in tfs.keys())
+                vals.extend(tfs.values())
+            indptr.append(len(cols))
+        self._indptr = np.asarray(indptr, dtype=np.int64)
+        self._page_ids = np.asarray(cols, dtype=np.int64)
+        self._tfs = np.asarray(vals, dtype=np.float32)
+        df = np.diff(self._indptr)
+
+        n = len(page_len)
+        page_len = np.asarray(page_len, dtype=np.float32)
+        avgdl = max(float(page_len.mean()), 1.0) if n else 1.0
+        self._norm = self.k1 * (1 - self.b + self.b * page_len / avgdl)
+        # The "+1" keeps idf positive for terms that occur in most pages.
+        self._idf = np.log((n - df + 0.5) / (df + 0.5) + 1).astype(np.float32)
+        self._term_ids = term_ids
+        self._page_range = page_range
+        self._version = self.index.version
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+from qwen_agent.utils.utils import get_term_freq
+
+
+class InvertedIndex:
+    """Maps terms to the pages containing them, with term frequencies.
+
+    Every document is persisted as its own json file under `index_dir`, so
+    concurrent ingestion processes never rewrite each other's entries. The
+    in-memory postings are refreshed incrementally: only the files that were
+    added, changed or removed since the last lookup are (un)loaded.
+    If `index_dir` is None, the index only lives in memory.
+    """
+
+    def __init__(self, index_dir: Optional[str] = None):
+        self.index_dir = index_dir
+        # term -> url -> page index -> term frequency
+        self._postings: Dict[str, Dict[str, Dict[int, int]]] = {}
+        # url -> per-page term frequencies, needed for removal
+        self._docs: Dict[str, List[Dict[str, int]]] = {}
+        # file name -> (mtime, url)
+        self._files: Dict[str, Tuple[float, str]] = {}
+        # bumped on every change, so that rankers know when to refit
+        self.version = 0
+
+    def add_document(self, url: str, pages: List[Dict]):
+        page_terms = [
+            page['terms']
+            if 'terms' in page else get_term_freq(page['page_content'])
+            for page in pages
+        ]
+        if self.index_dir:
+            os.makedirs(self.index_dir, exist_ok=True)
+            fname = self._file_name(url)
+            path = os.path.join(self.index_dir, fname)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            data = {'url': url, 'pages': page_terms}
+            with open(tmp_path, 'w', encoding='utf-8') as fp:
+                json.dump(data, fp, ensure_ascii=False)
+            os.replace(tmp_path, path)  # atomic, readers never see half a file
+            self._files[fname] = (os.path.getmtime(path), url)
+        self._load(url, page_terms)
+
+    def remove_document(self, url: str):
+        if self.index_dir:
+            fname = self._file_name(url)
+            path = os.path.join(self.index_dir, fname)
+            if os.path.exists(path):
+                os.remove(path)
+            self._files.pop(fname, None)
+        self._unload(url)
+
+    def has_document(self, url: str) -> bool:
+        """Whether a document is indexed, possibly by another process."""
+        if self.index_dir:
+            return os.path.exists(
+                os.path.join(self.index_dir, self._file_name(url)))
+        return url in self._docs
+
+    def num_pages(self, url: str) -> int:
+        """Returns the number of indexed pages of a document, -1 if absent."""
+        if url not in self._docs:
+            return -1
+        return len(self._docs[url])
+
+    def documents(self) -> Dict[str, List[Dict[str, int]]]:
+        """Returns {url: per-page term frequencies} of all indexed documents."""
+        return self._docs
+
+    def postings(self) -> Dict[str, Dict[str, Dict[int, int]]]:
+        """Returns {term: {url: {page index: term frequency}}}."""
+        return self._postings
+
+    def lookup(self, term: str, url: str) -> Dict[int, int]:
+        """Returns {page index: term frequency} of the term in a document."""
+        return self._postings.get(term, {}).get(url, {})
+
+    def refresh(self):
+        """Picks up the documents (re)indexed or removed by other processes."""
+        if not (self.index_dir and os.path.isdir(self.index_dir)):
+            return
+        seen = set()
+        for entry in os.scandir(self.index_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            seen.add(entry.name)
+            mtime = entry.stat().st_mtime
+            cached = self._files.get(entry.name)
+            if cached and cached[0] == mtime:
+                continue
+            try:
+                with open(entry.path, 'r', encoding='utf-8') as fp:
+                    data = json.load(fp)
+            except (OSError, ValueError):
+                continue
+            self._load(data['url'], data['pages'])
+            self._files[entry.name] = (mtime, data['url'])
+        for fname in list(self._files.keys()):
+            if fname not in seen:
+                self._unload(self._files.pop(fname)[1])
+
+    def _load(self, url: str, page_terms: List[Dict[str, int]]):
+        self._unload(url)
+        self.version += 1
+        self._docs[url] = page_terms
+        for i, terms in enumerate(page_terms):
+            for term, tf in terms.items():
+                self._postings.setdefault(term, {}).setdefault(url, {})[i] = tf
+
+    def _unload(self, url: str):
+        page_terms = self._docs.pop(url, None)
+        if page_terms is None:
+            return
+        self.version += 1
+        for terms in page_terms:
+            for term in terms:
+                docs = self._postings.get(term)
+                if docs is None:
+                    continue
+                docs.pop(url, None)
+                if not docs:
+                    del self._postings[term]
+
+    @staticmethod
+    def _file_name(url: str) -> str:
+        return hashlib.md5(url.encode('utf-8')).hexdigest() + '.json'
@@ -1,59 +1,126 @@
-from typing import Dict, List
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
+from qwen_agent.memory.bm25 import BM25
+from qwen_agent.memory.inverted_index import InvertedIndex
 from qwen_agent.memory.similarity_search import SimilaritySearch
 from qwen_agent.schema import RefMaterial
-from qwen_agent.utils.utils import count_tokens
+from qwen_agent.utils.utils import (count_tokens, count_tokens_batch,
+                                    truncate_tokens)
 
 
 # TODO: Design the interface.
 class Memory:
 
-    def __init__(self):
-        pass
+    def __init__(self, index: Optional[InvertedIndex] = None):
+        self.index = index or InvertedIndex()
+        self.ranker = BM25(self.index)
+        # The index and the ranker are refreshed in place, so requests made
+        # concurrently, e.g. by several sessions of a server, take turns.
+        self._lock = threading.Lock()
 
     def get(self,
             query: str,
             records: list,
             llm=None,
             stream=False,
-            max_token=4000) -> List[Dict]:
+            max_token=4000,
+            global_rank=False) -> List[Dict]:
+        """Retrieves the reference material of the query within `max_token`.
 
-        search_agent = SimilaritySearch(llm=llm, stream=stream)
-        _ref_list = []
-        for record in records:
-            now_ref_list = search_agent.run(record, query)
-            if now_ref_list['text']:
-                _ref_list.append(now_ref_list)
+        By default, every record gets an equal share of the token budget.
+        With `global_rank`, the pages of all records compete for one budget
+        and are taken in the order of their relevance scores.
+        """
+        with self._lock:
+            return self._get(query, records, llm, stream, max_token,
+                             global_rank)
+
+    def _get(self, query: str, records: list, llm, stream: bool,
+             max_token: int, global_rank: bool) -> List[Dict]:
+        self.index.refresh()
+        search_agent = SimilaritySearch(llm=llm,
+                                        stream=stream,
+                                        ranker=self.ranker)
+        if global_rank:
+            ref_dict = {}
+            ranked_pages = self._drop_duplicates(
+                search_agent.iter_ranked_pages(records, query))
+            for url, x in self._take_within_budget(ranked_pages, max_token):
+                ref_dict.setdefault(url, {'url': url, 'text': []})
+                ref_dict[url]['text'].append(x)
+            if ref_dict:
+                return list(ref_dict.values())
+            _ref_list = []
+        else:
+            pages_per_record = search_agent.search_pages(records, query)
+            _ref_list = [(record['url'], pages)
+                         for record, pages in zip(records, pages_per_record)
+                         if pages]
 
         if not _ref_list:
-            _ref_list = self.get_top(records)
-        # token number
+            _ref_list = self._get_top_pages(records)
+        # token number, counted in one batch so that the loop hits the cache
+        count_tokens_batch([
+            page['page_content'] for _, pages in _ref_list for page in pages
+            if 'token_num' not in page
+        ])
         new_ref_list = []
         single_max_token = int(max_token / len(_ref_list))
-        for _ref in _ref_list:
-            tmp = {'url': _ref['url'], 'text': []}
-            now_token = 0
-
-            for x in _ref['text']:
-                lenx = count_tokens(x)
-                if (now_token + lenx) <= single_max_token:
-                    tmp['text'].append(x)
-                    now_token += lenx
-                else:
-                    use_rate = (single_max_token - now_token) / lenx
-                    tmp['text'].append(x[:int(len(x) * use_rate)])
-                    break
+        for url, pages in _ref_list:
+            tmp = {'url': url, 'text': []}
+            pages = ((url, page) for page in pages)
+            for _, x in self._take_within_budget(pages, single_max_token):
+                tmp['text'].append(x)
             new_ref_list.append(tmp)
 
         return new_ref_list
 
+    @staticmethod
+    def _take_within_budget(pages: Iterable[Tuple[str, Dict]],
+                            max_token: int) -> Iterator[Tuple[str, str]]:
+        """Yields the (url, text) of pages in order until max_token is used up.
+
+        The token count precomputed at ingest time is used when available.
+        """
+        now_token = 0
+        for url, page in pages:
+            x = page['page_content']
+            lenx = page.get('token_num')
+            if lenx is None:
+                lenx = count_tokens(x)
+            if (now_token + lenx) <= max_token:
+                yield url, x
+                now_token += lenx
+            else:
+                yield url, truncate_tokens(x, max_token - now_token)
+                break
+
+    @staticmethod
+    def _drop_duplicates(
+            pages: Iterable[Tuple[str, Dict]]) -> Iterator[Tuple[str, Dict]]:
+        """Skips pages whose content was already taken from another record."""
+        seen = set()
+        for url, page in pages:
+            content_hash = page.get('content_hash')
+            if content_hash:
+                if content_hash in seen:
+                    continue
+                seen.add(content_hash)
+            yield url, page
+
     def get_top(self, records: list, k=6):
+        return [
+            RefMaterial(url=url, text=[x['page_content']
+                                       for x in pages]).to_dict()
+            for url, pages in self._get_top_pages(records, k)
+        ]
+
+    @staticmethod
+    def _get_top_pages(records: list, k=6) -> List[Tuple[str, List[Dict]]]:
         _ref_list = []
         for record in records:
             raw = record['raw']
             k = min(len(raw), k)
-            _ref_list.append(
-                RefMaterial(url=record['url'],
-                            text=[x['page_content']
-                                  for x in raw[:k]]).to_dict())
+            _ref_list.append((record['url'], raw[:k]))
         return _ref_list
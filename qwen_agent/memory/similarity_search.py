@@ -1,66 +1,119 @@
+import heapq
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from qwen_agent.memory.bm25 import BM25
+from qwen_agent.memory.inverted_index import InvertedIndex
 from qwen_agent.schema import RefMaterial
 from qwen_agent.utils.utils import get_split_word
 
+# The pages of a document are ranked this many at first, then twice as many
+# each time those run out, see iter_ranked_pages().
+RANK_BLOCK_SIZE = 8
+
 
 class SimilaritySearch:
 
-    def __init__(self, llm=None, stream=False):
+    def __init__(self, llm=None, stream=False, ranker: BM25 = None):
         self.llm = llm
         self.stream = stream
+        self.ranker = ranker or BM25(InvertedIndex())
 
     def run(self, line, query):
         """
         Input: one line
         Output: the relative text
         """
+        return self.search([line], query)[0]
+
+    def search(self, lines: List[Dict], query: str) -> List[Dict]:
+        """Ranks the pages of all lines at once, with a single BM25 pass."""
+        return [
+            RefMaterial(url=line['url'],
+                        text=[x['page_content'] for x in pages]).to_dict()
+            for line, pages in zip(lines, self.search_pages(lines, query))
+        ]
+
+    def search_pages(self, lines: List[Dict], query: str) -> List[List[Dict]]:
+        """Returns the relevant pages of each line, in the order of lines."""
+        scores = self._get_scores(lines, query)
+        if scores is None:
+            return [[] for _ in lines]
+
+        res = []
+        for line in lines:
+            start, end = self.ranker.page_range(line['url'])
+            res.append(self._select_pages(line, scores[start:end]))
+        return res
+
+    def iter_ranked_pages(self, lines: List[Dict],
+                          query: str) -> Iterator[Tuple[str, Dict]]:
+        """Yields the (url, page) of relevant pages of all lines, best first.
+
+        The lines are combined with a heap-based k-way merge. Each line is
+        ranked lazily, in blocks of RANK_BLOCK_SIZE best pages that double
+        in size, which are partitioned out of its scores and only then sorted.
+        So few more pages are sorted than the consumer takes.
+        """
+        scores = self._get_scores(lines, query)
+        if scores is None:
+            return
+
+        def _iter_line(line: Dict) -> Iterator[Tuple[float, str, Dict]]:
+            start, end = self.ranker.page_range(line['url'])
+            sims = scores[start:end]
+            rest = np.flatnonzero(sims > 0)
+            size = RANK_BLOCK_SIZE
+            while rest.size:
+                if rest.size > size:
+                    # The best pages, with all those tied with the last one.
+                    last = -np.partition(-sims[rest], size - 1)[size - 1]
+                    block = rest[sims[rest] >= last]
+                    rest = rest[sims[rest] < last]
+                else:
+                    block, rest = rest, rest[:0]
+                # By score, then by page, as a stable sort would.
+                for i in block[np.lexsort((block, -sims[block]))].tolist():
+                    yield float(sims[i]), line['url'], line['raw'][i]
+                size *= 2
+
+        for _, url, page in heapq.merge(*[_iter_line(x) for x in lines],
+                                        key=lambda item: -item[0]):
+            yield url, page
+
+    def _get_scores(self, lines: List[Dict],
+                    query: str) -> Optional[np.ndarray]:
         wordlist = get_split_word(query)
         if not wordlist:
-            return RefMaterial(url=line['url'], text=[]).to_dict()
+            return None
+
+        index = self.ranker.index
+        for line in lines:
+            if index.num_pages(line['url']) != len(line['raw']):
+                # cached before the index existed, or re-cached since
+                index.add_document(line['url'], line['raw'])
+        return self.ranker.get_scores(wordlist)
 
+    @staticmethod
+    def _select_pages(line: Dict, sims: np.ndarray) -> List[Dict]:
         content = line['raw']
+        assert len(sims) > 0
 
         res = []
-        sims = []
-        for i, page in enumerate(content):
-            sim = self.filter_section(page, wordlist)
-            sims.append([i, sim])
-        sims.sort(key=lambda item: item[1], reverse=True)
-
-        assert len(sims) > 0
         found_page_first = {0: False, 1: False}
-
-        max_sims = sims[0][1]
-        if max_sims != 0:
-            for i, x in enumerate(sims):
-                if i > 3:
-                    break
-                page = content[x[0]]
-                text = page['page_content']
-                res.append(text)
-                if x[0] in found_page_first.keys():
-                    found_page_first[x[0]] = True
+        order = np.argsort(-sims, kind='stable')
+        if sims[order[0]] > 0:
+            for i in order[:4].tolist():
+                res.append(content[i])
+                if i in found_page_first.keys():
+                    found_page_first[i] = True
 
             # manually add pages
             for k in found_page_first.keys():
                 if k >= len(content):
                     break
                 if not found_page_first[k]:
-                    page = content[k]
-                    text = page['page_content']
-                    res.append(text)
-
-        return RefMaterial(url=line['url'], text=res).to_dict()
-
-    def filter_section(self, page, wordlist):
-        text = page['page_content']
-
-        page_list = get_split_word(text)
-        sim = self.jaccard_similarity(wordlist, page_list)
-
-        return sim
+                    res.append(content[k])
 
-    def jaccard_similarity(self, list1, list2):
-        s1 = set(list1)
-        s2 = set(list2)
-        return len(s1.intersection(s2))  # avoid text length impact
-        # return len(s1.intersection(s2)) / len(s1.union(s2))  # jaccard similarity
+        return res
@@ -1,47 +1,170 @@
-from .code_interpreter import code_interpreter
-from .image_gen import image_gen
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+from .registry import TOOLS, ToolSpec, call_tool, register_tool, stream_tool
 
 # TODO: Meta info in multiple language such as en and zh.
 # TODO: Use ChatGPT's schema for functions?
-# TODO: These meta info should be provided by the tools' classes.
-# TODO: Make this immutable once it is initialized.
-list_of_all_functions = [
-    {
-        'name_for_human': '代码解释器',
-        'name_for_model': 'code_interpreter',
-        'description_for_model': '代码解释器，可用于执行Python代码。' +
-        ' Enclose the code within triple backticks (`) at the beginning and end of the code.',
-        'parameters': [{
-            'name': 'code',
-            'type': 'string',
-            'description': '待执行的代码'
-        }]
-    },
-    {
-        'name_for_human':
-        '文生图',
-        'name_for_model':
-        'image_gen',
-        'description_for_model':
-        '文生图是一个AI绘画（图像生成）服务，输入文本描述，返回根据文本作画得到的图片的URL。' +
-        ' Format the arguments as a JSON object.',
-        'parameters': [{
-            'name': 'prompt',
-            'description': '英文关键词，描述了希望图像具有什么内容',
-            'required': True,
-            'schema': {
-                'type': 'string'
-            },
-        }],
-    },
-]
-
-
-# TODO: Say no to these if statements.
-def call_plugin(plugin_name: str, plugin_args: str) -> str:
-    if plugin_name == 'code_interpreter':
-        return code_interpreter(plugin_args)
-    elif plugin_name == 'image_gen':
-        return image_gen(plugin_args)
-    else:
-        raise NotImplementedError
+# The tool modules are imported on their first call: code_interpreter pulls
+# in matplotlib and jupyter_client, which e.g. the assistant server never
+# needs.
+register_tool(
+    ToolSpec(
+        name='code_interpreter',
+        schema={
+            'name_for_human':
+            '代码解释器',
+            'name_for_model':
+            'code_interpreter',
+            'description_for_model':
+            '代码解释器，可用于执行Python代码。' +
+            ' Enclose the code within triple backticks (`) at the beginning and end of the code.',
+            'parameters': [{
+                'name': 'code',
+                'type': 'string',
+                'description': '待执行的代码'
+            }]
+        },
+        function='qwen_agent.tools.code_interpreter:code_interpreter',
+        stream_function=(
+            'qwen_agent.tools.code_interpreter:code_interpreter_iter'),
+        timeout=30,
+        stateful=True,  # a kernel per session, which bounds concurrency
+    ))
+register_tool(
+    ToolSpec(
+        name='image_gen',
+        schema={
+            'name_for_human':
+            '文生图',
+            'name_for_model':
+            'image_gen',
+            'description_for_model':
+            '文生图是一个AI绘画（图像生成）服务，输入文本描述，返回根据文本作画得到的图片的URL。' +
+            ' Format the arguments as a JSON object.',
+            'parameters': [{
+                'name': 'prompt',
+                'description': '英文关键词，描述了希望图像具有什么内容',
+                'required': True,
+                'schema': {
+                    'type': 'string'
+                },
+            }],
+        },
+        function='qwen_agent.tools.image_gen:image_gen',
+        max_concurrency=8,
+        cacheable=True,
+    ))
+
+list_of_all_functions = [x.schema for x in TOOLS.values()]
+
+
+def call_plugin(plugin_name: str,
+                plugin_args: str,
+                session_id: Optional[str] = None) -> str:
+    return call_tool(plugin_name, plugin_args, session_id=session_id)
+
+
+def call_plugin_stream(plugin_name: str,
+                       plugin_args: str,
+                       session_id: Optional[str] = None) -> Iterator[str]:
+    """Yields the observation of a plugin in parts, as soon as they are ready."""
+    yield from stream_tool(plugin_name, plugin_args, session_id=session_id)
+
+
+# Runs the plugins of parallel function calls.
+_PLUGIN_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+
+def call_plugins_stream(
+        plugin_calls: List[Tuple[str, str]],
+        session_id: Optional[str] = None) -> List[Iterator[str]]:
+    """Runs several plugin calls concurrently, e.g. of one model turn.
+
+    Returns an iterator over the observation of each call, in the order of
+    the calls. The first one streams as it is produced, the others are
+    buffered until they are read. Stateful tools, e.g. the kernel of a
+    session, see their calls one after another, in order. A call whose
+    iterator is closed is stopped, see closing_streams().
+    """
+    if len(plugin_calls) == 1:
+        return [call_plugin_stream(*plugin_calls[0], session_id=session_id)]
+
+    streams = [_BufferedStream() for _ in plugin_calls]
+
+    def _run(indices: List[int]):
+        for i in indices:
+            if streams[i].abandoned.is_set():
+                continue
+            chunks = call_plugin_stream(*plugin_calls[i],
+                                        session_id=session_id)
+            try:
+                for chunk in chunks:
+                    streams[i].buffer.put(chunk)
+                    if streams[i].abandoned.is_set():
+                        break
+            except Exception as e:
+                streams[i].buffer.put(e)
+            finally:
+                chunks.close()
+            streams[i].buffer.put(None)
+
+    stateful_calls = [
+        i for i, (name, _) in enumerate(plugin_calls)
+        if name in TOOLS and TOOLS[name].stateful
+    ]
+    if stateful_calls:
+        _PLUGIN_EXECUTOR.submit(_run, stateful_calls)
+    for i in range(len(plugin_calls)):
+        if i not in stateful_calls:
+            _PLUGIN_EXECUTOR.submit(_run, [i])
+
+    return streams
+
+
+class _BufferedStream:
+    """The observation of a call run in the background, as it comes in."""
+
+    def __init__(self):
+        self.buffer: queue.Queue = queue.Queue()
+        self.abandoned = threading.Event()
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if self._done:
+            raise StopIteration
+        chunk = self.buffer.get()
+        if chunk is None:
+            self._done = True
+            raise StopIteration
+        if isinstance(chunk, Exception):
+            self._done = True
+            raise chunk
+        return chunk
+
+    def close(self):
+        # Unlike a generator's, this also works before the first chunk.
+        self.abandoned.set()
+        self._done = True
+
+
+@contextmanager
+def closing_streams(
+        streams: List[Iterator[str]]) -> Iterator[List[Iterator[str]]]:
+    """Closes the observation streams of plugin calls on exit.
+
+    So that, if the turn is abandoned mid-way, e.g. as its client went away,
+    the plugins stop and free their slots at once, not when the streams are
+    garbage-collected.
+    """
+    try:
+        yield streams
+    finally:
+        for x in streams:
+            x.close()
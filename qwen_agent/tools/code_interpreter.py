@@ -2,23 +2,24 @@ import asyncio
 import atexit
 import base64
 import glob
-import io
+import hashlib
 import json
 import os
 import queue
 import re
 import shutil
-import signal
 import subprocess
 import sys
+import threading
 import time
 import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
 from pathlib import Path
-from typing import Dict, Optional
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
 
 import matplotlib
-import PIL.Image
-from jupyter_client import BlockingKernelClient
+from jupyter_client import AsyncKernelClient, BlockingKernelClient
 
 sys.path.insert(0, str(Path(__file__).absolute().parent.parent.parent))  # NOQA
 
@@ -43,13 +44,31 @@ ALIB_FONT_FILE = str(
     Path(__file__).absolute().parent / 'resource' /
     'AlibabaPuHuiTi-3-45-Light.ttf')
 
-_KERNEL_CLIENTS: Dict[int, BlockingKernelClient] = {}
+POOL_SIZE = int(os.getenv('M6_CODE_INTERPRETER_POOL_SIZE', '1'))
+MAX_KERNELS = int(os.getenv('M6_CODE_INTERPRETER_MAX_KERNELS', '8'))
+KERNEL_IDLE_TIMEOUT = float(
+    os.getenv('M6_CODE_INTERPRETER_IDLE_TIMEOUT', '1800'))  # seconds
 
+# Bounds on the images served from WORK_DIR, see evict_images(). The age is
+# in seconds.
+IMAGE_MAX_BYTES = int(
+    os.getenv('M6_CODE_INTERPRETER_IMAGE_MAX_BYTES', str(512 * 1024 * 1024)))
+IMAGE_MAX_AGE = float(
+    os.getenv('M6_CODE_INTERPRETER_IMAGE_MAX_AGE', str(7 * 24 * 3600)))
+IMAGE_EVICTION_INTERVAL = 60  # seconds
 
-def _start_kernel(pid) -> BlockingKernelClient:
+# How often an async session checks whether its kernel is free (seconds).
+LOCK_POLL_INTERVAL = 0.05
+
+# Also covers kernels that are still starting when the process exits.
+_KERNEL_PROCESSES: List[subprocess.Popen] = []
+
+
+def _start_kernel(kernel_id) -> BlockingKernelClient:
     connection_file = os.path.join(WORK_DIR,
-                                   f'kernel_connection_file_{pid}.json')
-    launch_kernel_script = os.path.join(WORK_DIR, f'launch_kernel_{pid}.py')
+                                   f'kernel_connection_file_{kernel_id}.json')
+    launch_kernel_script = os.path.join(WORK_DIR,
+                                        f'launch_kernel_{kernel_id}.py')
     for f in [connection_file, launch_kernel_script]:
         if os.path.exists(f):
             logger.info(f'WARNING: {f} already exists')
@@ -70,6 +89,7 @@ def _start_kernel(pid) -> BlockingKernelClient:
     ],
                                       cwd=WORK_DIR)
     logger.info(f"INFO: kernel process's PID = {kernel_process.pid}")
+    _KERNEL_PROCESSES.append(kernel_process)
 
     # Wait for kernel connection file to be written
     while True:
@@ -83,6 +103,8 @@ def _start_kernel(pid) -> BlockingKernelClient:
                 break
             except json.JSONDecodeError:
                 pass
+    # The kernel has read its launch script by now.
+    os.remove(launch_kernel_script)
 
     # Client
     kc = BlockingKernelClient(connection_file=connection_file)
@@ -93,91 +115,416 @@ def _start_kernel(pid) -> BlockingKernelClient:
     return kc
 
 
+def _new_kernel() -> BlockingKernelClient:
+    """Starts a kernel and runs the init code in it."""
+    _fix_matplotlib_cjk_font_issue()
+    kc = _start_kernel(uuid.uuid4().hex)
+    with open(INIT_CODE_FILE) as fin:
+        start_code = fin.read()
+        start_code = start_code.replace('{{M6_FONT_PATH}}',
+                                        repr(ALIB_FONT_FILE)[1:-1])
+    logger.info(_execute_code(kc, start_code))
+    return kc
+
+
+class _KernelSession:
+
+    def __init__(self, kc: BlockingKernelClient):
+        self.kc = kc
+        self.lock = threading.Lock()  # one execution at a time per kernel
+        self.last_used = time.time()
+        # How many checked it out and have yet to release it, under the lock
+        # of the pool. Such a session is never evicted or reclaimed.
+        self.users = 0
+        # An async client to the same kernel, bound to the loop that made it.
+        self.akc: Optional[AsyncKernelClient] = None
+        self.akc_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def get_async_client(self) -> AsyncKernelClient:
+        loop = asyncio.get_running_loop()
+        if self.akc is None or self.akc_loop is not loop:
+            self.close_async_client()
+            akc = AsyncKernelClient(connection_file=self.kc.connection_file)
+            akc.load_connection_file()
+            akc.start_channels()
+            # Once per client, so that iopub is subscribed before executing.
+            await akc.wait_for_ready()
+            self.akc, self.akc_loop = akc, loop
+        return self.akc
+
+    def close_async_client(self):
+        if self.akc is not None:
+            self.akc.stop_channels()
+            self.akc, self.akc_loop = None, None
+
+    def shutdown(self):
+        self.close_async_client()
+        self.kc.shutdown()
+
+
+class KernelPool:
+    """Maps sessions (conversations) to dedicated, pre-warmed kernels.
+
+    `size` kernels are kept started and initialized ahead of their first use.
+    A kernel checked out by a session stays dedicated to it until the session
+    is evicted or reclaimed. It is then shut down rather than reused, because
+    it holds the variables of that session. The pool is topped up in the background after every
+    checkout, so a new session only waits if the pool has been drained.
+
+    Different sessions execute concurrently on their own kernels. At most
+    `max_kernels` sessions hold a kernel: beyond that, the least recently used
+    idle session is reclaimed. Sessions idle for `idle_timeout` seconds are
+    evicted as well.
+    """
+
+    def __init__(self,
+                 size: int = POOL_SIZE,
+                 max_kernels: int = MAX_KERNELS,
+                 idle_timeout: float = KERNEL_IDLE_TIMEOUT):
+        self.size = size
+        self.max_kernels = max_kernels
+        self.idle_timeout = idle_timeout
+        self._idle: queue.Queue = queue.Queue()
+        self._sessions: 'OrderedDict[str, _KernelSession]' = OrderedDict()
+        self._num_starting = 0
+        self._lock = threading.Lock()
+        self._reaper: Optional[threading.Thread] = None
+
+    @contextmanager
+    def session(self, session_id: str) -> Iterator[BlockingKernelClient]:
+        """Checks out the kernel of a session and holds it while in use."""
+        sess = self._checkout(session_id)
+        try:
+            with sess.lock:
+                yield sess.kc
+        finally:
+            self._release(sess)
+
+    @asynccontextmanager
+    async def async_session(
+            self, session_id: str) -> AsyncIterator[AsyncKernelClient]:
+        """Like session(), but yields an async client and never blocks the loop."""
+        loop = asyncio.get_running_loop()
+        checkout = loop.run_in_executor(None, self._checkout, session_id)
+        try:
+            sess = await asyncio.shield(checkout)
+        except asyncio.CancelledError:
+            # The checkout itself runs on, and is released once done.
+            checkout.add_done_callback(self._release_checkout)
+            raise
+        try:
+            # Polled rather than awaited in a thread, which would take the
+            # lock for nobody if this task were cancelled meanwhile.
+            while not sess.lock.acquire(blocking=False):
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+            try:
+                yield await sess.get_async_client()
+            finally:
+                sess.lock.release()
+        finally:
+            self._release(sess)
+
+    def replenish(self):
+        """Starts kernels in the background until `size` are idle."""
+        with self._lock:
+            num = self.size - self._idle.qsize() - self._num_starting
+            num = max(num, 0)
+            self._num_starting += num
+            if self._reaper is None and self.idle_timeout > 0:
+                self._reaper = threading.Thread(target=self._reap_idle,
+                                                daemon=True)
+                self._reaper.start()
+        for _ in range(num):
+            threading.Thread(target=self._add_idle_kernel, daemon=True).start()
+
+    def evict_idle(self):
+        """Shuts down the kernels of sessions idle for too long."""
+        deadline = time.time() - self.idle_timeout
+        with self._lock:
+            expired = [
+                k for k, v in self._sessions.items()
+                if v.last_used < deadline and not v.users
+            ]
+            evicted = [self._sessions.pop(k) for k in expired]
+        for session_id, sess in zip(expired, evicted):
+            logger.info(f'Evicting the idle kernel of session {session_id}')
+            sess.shutdown()
+
+    def shutdown(self):
+        with self._lock:
+            kernels = [v.kc for v in self._sessions.values()]
+            self._sessions.clear()
+            while not self._idle.empty():
+                kernels.append(self._idle.get_nowait())
+        for kc in kernels:
+            kc.shutdown()  # at exit, no need to close the async clients
+
+    def _checkout(self, session_id: str) -> _KernelSession:
+        with self._lock:
+            sess = self._sessions.get(session_id)
+            if sess is not None:
+                self._sessions.move_to_end(session_id)
+                self._use(sess)
+                return sess
+            try:
+                kc = self._idle.get_nowait()
+            except queue.Empty:
+                kc = None
+        if kc is None:
+            kc = _new_kernel()  # the pool is drained, start one on demand
+        with self._lock:
+            if session_id in self._sessions:  # lost a race with the session
+                self._idle.put(kc)
+                sess = self._sessions[session_id]
+                self._use(sess)
+                return sess
+            sess = _KernelSession(kc)
+            self._use(sess)
+            self._sessions[session_id] = sess
+            reclaimed = self._pop_lru_sessions()
+        for v in reclaimed:
+            v.shutdown()
+        self.replenish()
+        return sess
+
+    def _use(self, sess: _KernelSession):
+        # Must hold self._lock.
+        sess.users += 1
+        sess.last_used = time.time()
+
+    def _release(self, sess: _KernelSession):
+        with self._lock:
+            sess.users -= 1
+            sess.last_used = time.time()
+
+    def _release_checkout(self, checkout: asyncio.Future):
+        if not checkout.cancelled() and checkout.exception() is None:
+            self._release(checkout.result())
+
+    def _pop_lru_sessions(self) -> List[_KernelSession]:
+        # Must hold self._lock. Sessions in use are never reclaimed.
+        reclaimed = []
+        for k in list(self._sessions.keys()):
+            if len(self._sessions) <= self.max_kernels:
+                break
+            if not self._sessions[k].users:
+                logger.info(f'Reclaiming the kernel of session {k}')
+                reclaimed.append(self._sessions.pop(k))
+        return reclaimed
+
+    def _reap_idle(self):
+        while True:
+            time.sleep(min(self.idle_timeout, 60))
+            try:
+                self.evict_idle()
+            except Exception:
+                print_traceback()
+
+    def _add_idle_kernel(self):
+        try:
+            self._idle.put(_new_kernel())
+        except Exception:
+            print_traceback()
+        finally:
+            with self._lock:
+                self._num_starting -= 1
+
+
+_KERNEL_POOL = KernelPool()
+
+
+def prewarm_kernels():
+    _KERNEL_POOL.replenish()
+
+
 def _kill_kernels():
-    for v in _KERNEL_CLIENTS.values():
-        v.shutdown()
-    for k in list(_KERNEL_CLIENTS.keys()):
-        del _KERNEL_CLIENTS[k]
+    _KERNEL_POOL.shutdown()
+    for p in _KERNEL_PROCESSES:
+        if p.poll() is None:
+            p.kill()
 
 
+# Signals are left to the application, which should exit on them (rather than
+# be killed by them) for this to run.
 atexit.register(_kill_kernels)
-signal.signal(signal.SIGTERM, _kill_kernels)
-signal.signal(signal.SIGINT, _kill_kernels)
 
 
 def _serve_image(image_base64: str) -> str:
-    image_file = f'{uuid.uuid4()}.png'
+    # The kernel already sends a PNG, so the bytes are written as they are.
+    # Naming the file by its content makes repeated figures share one file.
+    png_bytes = base64.b64decode(image_base64)
+    image_file = hashlib.md5(png_bytes).hexdigest() + '.png'
     local_image_file = os.path.join(WORK_DIR, image_file)
 
-    png_bytes = base64.b64decode(image_base64)
-    assert isinstance(png_bytes, bytes)
-    bytes_io = io.BytesIO(png_bytes)
-    PIL.Image.open(bytes_io).save(local_image_file, 'png')
+    if os.path.exists(local_image_file):
+        os.utime(local_image_file)  # recently used, evict it last
+    else:
+        tmp_file = f'{local_image_file}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_file, 'wb') as fout:
+            fout.write(png_bytes)
+        os.replace(tmp_file, local_image_file)
+    _maybe_evict_images()
 
     image_url = f'{STATIC_URL}/{image_file}'
     return image_url
 
 
+_IMAGE_FILE_RE = re.compile(r'^[0-9a-f]{32}\.png$')
+_last_image_eviction = 0.0
+
+
+def _maybe_evict_images():
+    global _last_image_eviction
+    now = time.time()
+    if now - _last_image_eviction < IMAGE_EVICTION_INTERVAL:
+        return
+    _last_image_eviction = now
+    try:
+        evict_images()
+    except OSError:
+        print_traceback()
+
+
+def evict_images(max_bytes: int = IMAGE_MAX_BYTES,
+                 max_age: float = IMAGE_MAX_AGE) -> int:
+    """Removes the served images that are too old, then the least recently
+    used ones until they take up at most `max_bytes`.
+
+    Only the images named by content hash are touched, not the other files
+    of the workspace. Returns the number of images removed.
+    """
+    if not os.path.isdir(WORK_DIR):
+        return 0
+    images = []
+    for entry in os.scandir(WORK_DIR):
+        if _IMAGE_FILE_RE.match(entry.name):
+            stat = entry.stat()
+            images.append((stat.st_mtime, stat.st_size, entry.path))
+    images.sort()
+
+    deadline = time.time() - max_age
+    total = sum(x[1] for x in images)
+    num = 0
+    for mtime, size, path in images:
+        if mtime >= deadline and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:  # removed by another process
+            pass
+        total -= size
+        num += 1
+    return num
+
+
 def _escape_ansi(line: str) -> str:
     ansi_escape = re.compile(r'(?:\x1B[@-_]|[\x80-\x9F])[0-?]*[ -/]*[@-~]')
     return ansi_escape.sub('', line)
 
 
+def _format_iopub_msg(msg: Dict, image_idx: int) -> Tuple[str, int, bool]:
+    """Renders an iopub message as part of the observation.
+
+    Returns the text (possibly empty), the updated image counter and whether
+    the execution has finished.
+    """
+    text = ''
+    image = ''
+    finished = False
+    msg_type = msg['msg_type']
+    if msg_type == 'status':
+        if msg['content'].get('execution_state') == 'idle':
+            finished = True
+    elif msg_type == 'execute_result':
+        text = msg['content']['data'].get('text/plain', '')
+        if 'image/png' in msg['content']['data']:
+            image_b64 = msg['content']['data']['image/png']
+            image_url = _serve_image(image_b64)
+            image_idx += 1
+            image = '![fig-%03d](%s)' % (image_idx, image_url)
+    elif msg_type == 'display_data':
+        if 'image/png' in msg['content']['data']:
+            image_b64 = msg['content']['data']['image/png']
+            image_url = _serve_image(image_b64)
+            image_idx += 1
+            image = '![fig-%03d](%s)' % (image_idx, image_url)
+        else:
+            text = msg['content']['data'].get('text/plain', '')
+    elif msg_type == 'stream':
+        msg_type = msg['content']['name']  # stdout, stderr
+        text = msg['content']['text']
+    elif msg_type == 'error':
+        text = _escape_ansi('\n'.join(msg['content']['traceback']))
+        if 'M6_CODE_INTERPRETER_TIMEOUT' in text:
+            text = 'Timeout: Code execution exceeded the time limit.'
+    return _format_output(msg_type, text, image), image_idx, finished
+
+
+def _format_output(msg_type: str, text: str, image: str = '') -> str:
+    result = ''
+    if text:
+        result += f'\n\n{msg_type}:\n\n```\n{text}\n```'
+    if image:
+        result += f'\n\n{image}'
+    return result
+
+
+_TIMEOUT_OUTPUT = _format_output(
+    'error', 'Timeout: Code execution exceeded the time limit.')
+_UNEXPECTED_ERROR_OUTPUT = _format_output(
+    'error', 'The code interpreter encountered an unexpected error.')
+
+
 def _execute_code(kc: BlockingKernelClient, code: str) -> str:
-    kc.wait_for_ready()
-    kc.execute(code)
+    # No wait_for_ready() here: it is done once when the kernel starts, and it
+    # costs ~200ms per call because it drains iopub with a timeout.
+    msg_id = kc.execute(code)
     result = ''
     image_idx = 0
     while True:
-        text = ''
-        image = ''
-        finished = False
-        msg_type = 'error'
         try:
             msg = kc.get_iopub_msg()
-            msg_type = msg['msg_type']
-            if msg_type == 'status':
-                if msg['content'].get('execution_state') == 'idle':
-                    finished = True
-            elif msg_type == 'execute_result':
-                text = msg['content']['data'].get('text/plain', '')
-                if 'image/png' in msg['content']['data']:
-                    image_b64 = msg['content']['data']['image/png']
-                    image_url = _serve_image(image_b64)
-                    image_idx += 1
-                    image = '![fig-%03d](%s)' % (image_idx, image_url)
-            elif msg_type == 'display_data':
-                if 'image/png' in msg['content']['data']:
-                    image_b64 = msg['content']['data']['image/png']
-                    image_url = _serve_image(image_b64)
-                    image_idx += 1
-                    image = '![fig-%03d](%s)' % (image_idx, image_url)
-                else:
-                    text = msg['content']['data'].get('text/plain', '')
-            elif msg_type == 'stream':
-                msg_type = msg['content']['name']  # stdout, stderr
-                text = msg['content']['text']
-            elif msg_type == 'error':
-                text = _escape_ansi('\n'.join(msg['content']['traceback']))
-                if 'M6_CODE_INTERPRETER_TIMEOUT' in text:
-                    text = 'Timeout: Code execution exceeded the time limit.'
+            if msg['parent_header'].get('msg_id') != msg_id:
+                continue  # left over from an earlier, interrupted execution
+            output, image_idx, finished = _format_iopub_msg(msg, image_idx)
         except queue.Empty:
-            text = 'Timeout: Code execution exceeded the time limit.'
-            finished = True
+            output, finished = _TIMEOUT_OUTPUT, True
         except Exception:
-            text = 'The code interpreter encountered an unexpected error.'
             print_traceback()
-            finished = True
-        if text:
-            result += f'\n\n{msg_type}:\n\n```\n{text}\n```'
-        if image:
-            result += f'\n\n{image}'
+            output, finished = _UNEXPECTED_ERROR_OUTPUT, True
+        result += output
         if finished:
             break
     result = result.lstrip('\n')
     return result
 
 
+async def _aiter_execute_code(akc: AsyncKernelClient,
+                              code: str) -> AsyncIterator[str]:
+    """Like _execute_code, but yields the outputs as the kernel sends them."""
+    msg_id = akc.execute(code)
+    image_idx = 0
+    is_first = True
+    while True:
+        try:
+            msg = await akc.get_iopub_msg()
+            if msg['parent_header'].get('msg_id') != msg_id:
+                continue
+            output, image_idx, finished = _format_iopub_msg(msg, image_idx)
+        except queue.Empty:
+            output, finished = _TIMEOUT_OUTPUT, True
+        except Exception:
+            print_traceback()
+            output, finished = _UNEXPECTED_ERROR_OUTPUT, True
+        if output and is_first:
+            output = output.lstrip('\n')
+            is_first = False
+        if output:
+            yield output
+        if finished:
+            break
+
+
 def _fix_matplotlib_cjk_font_issue():
     ttf_name = os.path.basename(ALIB_FONT_FILE)
     local_ttf = os.path.join(
@@ -198,25 +545,81 @@ def _fix_matplotlib_cjk_font_issue():
             print_traceback()
 
 
-def code_interpreter(action_input: str, timeout: Optional[int] = 30) -> str:
+def code_interpreter(action_input: str,
+                     timeout: Optional[int] = 30,
+                     session_id: Optional[str] = None) -> str:
+    """Runs code in the kernel of a session, by default one per process.
+
+    Calls of the same session run one after another on the same kernel,
+    while calls of different sessions run concurrently on their own kernels.
+    """
     code = extract_code(action_input)
 
     if not code.strip():
         return ''
 
-    pid: int = os.getpid()
-    if pid in _KERNEL_CLIENTS:
-        kc = _KERNEL_CLIENTS[pid]
-    else:
-        _fix_matplotlib_cjk_font_issue()
-        kc = _start_kernel(pid)
-        with open(INIT_CODE_FILE) as fin:
-            start_code = fin.read()
-            start_code = start_code.replace('{{M6_FONT_PATH}}',
-                                            repr(ALIB_FONT_FILE)[1:-1])
-        logger.info(_execute_code(kc, start_code))
-        _KERNEL_CLIENTS[pid] = kc
+    with _KERNEL_POOL.session(session_id or str(os.getpid())) as kc:
+        return _run_code(kc, code, timeout)
+
+
+async def code_interpreter_stream(
+        action_input: str,
+        timeout: Optional[int] = 30,
+        session_id: Optional[str] = None) -> AsyncIterator[str]:
+    """Like code_interpreter, but yields the outputs as they are produced.
+
+    The chunks (stdout/stderr, images, results) concatenate to what
+    code_interpreter would have returned.
+    """
+    code = extract_code(action_input)
 
+    if not code.strip():
+        return
+
+    session_id = session_id or str(os.getpid())
+    async with _KERNEL_POOL.async_session(session_id) as akc:
+        async for chunk in _aiter_execute_code(akc, _fix_code(code, timeout)):
+            yield chunk
+        if timeout:
+            async for _ in _aiter_execute_code(akc,
+                                               '_M6CountdownTimer.cancel()'):
+                pass
+
+
+def code_interpreter_iter(action_input: str,
+                          timeout: Optional[int] = 30,
+                          session_id: Optional[str] = None) -> Iterator[str]:
+    """A blocking adapter of code_interpreter_stream, for sync callers."""
+    loop = _get_stream_loop()
+    agen = code_interpreter_stream(action_input, timeout, session_id)
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(agen.__anext__(),
+                                                       loop).result()
+            except StopAsyncIteration:
+                break
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+
+_STREAM_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_STREAM_LOOP_LOCK = threading.Lock()
+
+
+def _get_stream_loop() -> asyncio.AbstractEventLoop:
+    # One background loop for all sync callers, so that the async clients it
+    # creates can be reused across calls.
+    global _STREAM_LOOP
+    with _STREAM_LOOP_LOCK:
+        if _STREAM_LOOP is None:
+            _STREAM_LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_STREAM_LOOP.run_forever,
+                             daemon=True).start()
+    return _STREAM_LOOP
+
+
+def _fix_code(code: str, timeout: Optional[int]) -> str:
     if timeout:
         code = f'_M6CountdownTimer.start({timeout})\n{code}'
 
@@ -226,8 +629,12 @@ def code_interpreter(action_input: str, timeout: Optional[int] = 30) -> str:
         if line.startswith('sns.set_theme('):
             fixed_code.append(
                 'plt.rcParams["font.family"] = _m6_font_prop.get_name()')
-    fixed_code = '\n'.join(fixed_code)
-    result = _execute_code(kc, fixed_code)
+    return '\n'.join(fixed_code)
+
+
+def _run_code(kc: BlockingKernelClient, code: str,
+              timeout: Optional[int]) -> str:
+    result = _execute_code(kc, _fix_code(code, timeout))
 
     if timeout:
         _execute_code(kc, '_M6CountdownTimer.cancel()')
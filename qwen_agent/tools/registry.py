@@ -0,0 +1,115 @@
+import importlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, Optional
+
+
+@dataclass
+class ToolSpec:
+    """Declares a tool, without importing the module that implements it.
+
+    `function` (and `stream_function`, which yields the observation in parts)
+    are given as 'module:attribute', and are only imported on the first call.
+    A tool with a `timeout` receives it as a keyword argument, and a
+    `stateful` tool receives the `session_id` of the conversation.
+    """
+    name: str
+    schema: Dict
+    function: str
+    stream_function: Optional[str] = None
+    timeout: Optional[int] = None
+    max_concurrency: Optional[int] = None  # None for unlimited
+    cacheable: bool = False  # the same arguments always give the same result
+    stateful: bool = False
+    _semaphore: Optional[threading.BoundedSemaphore] = field(default=None,
+                                                             repr=False)
+
+    def __post_init__(self):
+        if self.max_concurrency:
+            self._semaphore = threading.BoundedSemaphore(self.max_concurrency)
+
+
+# The single dispatch table, tool name -> spec, in the order of registration.
+TOOLS: 'OrderedDict[str, ToolSpec]' = OrderedDict()
+
+_CACHE_SIZE = 256
+_cache: 'OrderedDict[tuple, str]' = OrderedDict()
+_cache_lock = threading.Lock()
+_functions: Dict[str, Callable] = {}
+_import_lock = threading.Lock()
+
+
+def register_tool(spec: ToolSpec):
+    TOOLS[spec.name] = spec
+
+
+def call_tool(name: str, args: str, session_id: Optional[str] = None) -> str:
+    spec = _get_spec(name)
+    if spec.cacheable:
+        with _cache_lock:
+            if (name, args) in _cache:
+                _cache.move_to_end((name, args))
+                return _cache[(name, args)]
+    fn = _import(spec.function)
+    with _limit(spec):
+        result = fn(args, **_get_kwargs(spec, session_id))
+    if spec.cacheable:
+        with _cache_lock:
+            _cache[(name, args)] = result
+            while len(_cache) > _CACHE_SIZE:
+                _cache.popitem(last=False)
+    return result
+
+
+def stream_tool(name: str,
+                args: str,
+                session_id: Optional[str] = None) -> Iterator[str]:
+    spec = _get_spec(name)
+    if not spec.stream_function:
+        yield call_tool(name, args, session_id=session_id)
+        return
+    fn = _import(spec.stream_function)
+    with _limit(spec):
+        chunks = fn(args, **_get_kwargs(spec, session_id))
+        try:
+            yield from chunks
+        finally:
+            # Also when the caller closes this early, e.g. as its client went
+            # away, so that the tool stops and its slot is free at once.
+            chunks.close()
+
+
+def _get_spec(name: str) -> ToolSpec:
+    if name not in TOOLS:
+        raise NotImplementedError
+    return TOOLS[name]
+
+
+def _get_kwargs(spec: ToolSpec, session_id: Optional[str]) -> Dict:
+    kwargs = {}
+    if spec.timeout:
+        kwargs['timeout'] = spec.timeout
+    if spec.stateful:
+        kwargs['session_id'] = session_id
+    return kwargs
+
+
+@contextmanager
+def _limit(spec: ToolSpec):
+    if spec._semaphore is None:
+        yield
+    else:
+        with spec._semaphore:
+            yield
+
+
+def _import(path: str) -> Callable:
+    fn = _functions.get(path)
+    if fn is None:
+        with _import_lock:
+            module, attr = path.split(':')
+            fn = getattr(importlib.import_module(module), attr)
+            _functions[path] = fn
+    return fn
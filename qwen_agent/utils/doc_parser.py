@@ -1,33 +1,320 @@
+import functools
+import importlib
+import multiprocessing
+import os
 import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import contextmanager
+from html.parser import HTMLParser
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
+# PDF pages are extracted by this many processes, a few pages per task.
+PDF_WORKERS = int(os.getenv('QWEN_AGENT_PDF_WORKERS') or os.cpu_count() or 1)
+PDF_PAGES_PER_TASK = 4
 
-def parse_pdf_pypdf(path):
-    from langchain.document_loaders import PyPDFLoader
+# Pages are split into chunks this long, as langchain's load_and_split did.
+CHUNK_SIZE = 4000
+CHUNK_OVERLAP = 200
 
-    loader = PyPDFLoader(path)
-    pages = loader.load_and_split()
-    res = [{
-        'page_content': page.page_content,
-        'metadata': page.metadata
-    } for page in pages]
-    return res
+
+def split_text(
+    text: str,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    separators: Tuple[str, ...] = ('\n\n', '\n', ' ', '')
+) -> List[str]:
+    """Splits a text into chunks of at most `chunk_size` characters.
+
+    Splits at the first of the separators found in the text, splitting the
+    parts that are still too long at the next ones. Consecutive chunks share
+    up to `chunk_overlap` characters. Blank chunks are dropped.
+    """
+    if len(text) <= chunk_size:
+        return [text] if text.strip() else []
+    sep = next(x for x in separators if not x or x in text)
+    finer = separators[separators.index(sep) + 1:]
+    chunks, current, length = [], [], 0  # length of sep.join(current)
+    for part in (text.split(sep) if sep else list(text)):
+        if len(part) > chunk_size:
+            if current:
+                chunks.append(sep.join(current))
+                current, length = [], 0
+            chunks.extend(split_text(part, chunk_size, chunk_overlap, finer))
+            continue
+        if current and length + len(sep) + len(part) > chunk_size:
+            chunks.append(sep.join(current))
+            # Carry over the tail of the chunk, as long as it fits.
+            while current and (length > chunk_overlap
+                               or length + len(sep) + len(part) > chunk_size):
+                length -= len(current.pop(0)) + (len(sep) if current else 0)
+        length += len(part) + (len(sep) if current else 0)
+        current.append(part)
+    if current:
+        chunks.append(sep.join(current))
+    return [x for x in chunks if x.strip()]
+
+
+_pdf_executor: Optional[Executor] = None
+_pdf_executor_lock = threading.Lock()
+# The reader of the PDF last extracted from in this process, by file.
+_last_pdf_reader: Tuple[Optional[tuple], object] = (None, None)
+
+
+def _get_pdf_executor() -> Executor:
+    """The pool of PDF_WORKERS processes shared by all PDFs of this process.
+
+    Its workers come from a fork server rather than from forking this process,
+    whose other threads (e.g. of Gradio) might hold locks at the time.
+    """
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is None:
+            _pdf_executor = ProcessPoolExecutor(
+                PDF_WORKERS,
+                mp_context=multiprocessing.get_context('forkserver'))
+        return _pdf_executor
+
+
+def _get_pdf_reader(path: str):
+    # The batches of a PDF mostly go to the same workers, which then parse
+    # its file once.
+    global _last_pdf_reader
+    from pypdf import PdfReader
+
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if _last_pdf_reader[0] != key:
+        _last_pdf_reader = (key, PdfReader(path))
+    return _last_pdf_reader[1]
+
+
+def _extract_pdf_pages(path: str, source: str, start: int,
+                       end: int) -> Tuple[List[Dict], float]:
+    """Extracts pages [start, end), returns them and the time it took."""
+    t = time.perf_counter()
+    reader = _get_pdf_reader(path)
+    pages = []
+    for i in range(start, end):
+        text = reader.pages[i].extract_text()
+        pages.extend({
+            'page_content': chunk,
+            'metadata': {
+                'source': source,
+                'page': i
+            }
+        } for chunk in split_text(text))
+    return pages, time.perf_counter() - t
+
+
+@contextmanager
+def local_copy(path: str) -> Iterator[str]:
+    """Yields the path of a local copy of a file, downloaded if remote."""
+    if not (path.startswith('https://') or path.startswith('http://')):
+        yield path
+        return
+    fd, tmp_path = tempfile.mkstemp(suffix='.pdf')
+    try:
+        with os.fdopen(fd, 'wb') as fp, urllib.request.urlopen(path) as rsp:
+            shutil.copyfileobj(rsp, fp)
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
+
+
+def iter_pdf_pages(
+    path: str,
+    source: Optional[str] = None,
+    pages_per_task: int = PDF_PAGES_PER_TASK
+) -> Iterator[Tuple[List[Dict], float]]:
+    """Yields the pages of a PDF in order, a few at a time, as extracted.
+
+    The pages are extracted by a pool of processes, shared by all PDFs, since
+    text extraction is CPU-bound. Each batch comes with the time its worker spent on it, and is
+    yielded as soon as it and the batches before it are done. The pages are
+    attributed to `source`, which defaults to `path`.
+    """
+    source = source or path
+    # The workers all read the file, so a remote one is downloaded once.
+    with local_copy(path) as local_path:
+        num_pages = len(_get_pdf_reader(local_path).pages)
+        ranges = [(i, min(i + pages_per_task, num_pages))
+                  for i in range(0, num_pages, pages_per_task)]
+        if len(ranges) <= 1 or PDF_WORKERS <= 1:
+            for start, end in ranges:
+                yield _extract_pdf_pages(local_path, source, start, end)
+            return
+        executor = _get_pdf_executor()
+        futures = [
+            executor.submit(_extract_pdf_pages, local_path, source, start, end)
+            for start, end in ranges
+        ]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def parse_pdf_pypdf(path: str) -> List[Dict]:
+    return [page for pages, _ in iter_pdf_pages(path) for page in pages]
 
 
 def pre_process_html(s):
-    # replace multiple newlines
-    s = re.sub('\n+', '\n', s)
     # replace special string
     s = s.replace("Add to Qwen's Reading List", '')
+    # replace multiple newlines
+    s = re.sub('\n+', '\n', s)
     return s
 
 
-def parse_html_bs(path):
-    from langchain.document_loaders import BSHTMLLoader
+# Elements whose text is not part of the content of a page. The title of the
+# page is the first <title> outside of them (but for the head), not e.g. that
+# of an svg icon.
+_BOILERPLATE_TAGS = ('head', 'script', 'style', 'noscript', 'template', 'svg',
+                     'canvas', 'iframe', 'nav', 'header', 'footer', 'aside',
+                     'form', 'button', 'select')
+# Elements that start a new line of text.
+_BLOCK_TAGS = frozenset([
+    'address', 'article', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt',
+    'figcaption', 'figure', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'li',
+    'main', 'ol', 'p', 'pre', 'section', 'table', 'td', 'th', 'tr', 'ul'
+])
+
+
+def _html_to_text_selectolax(html: str) -> Tuple[str, str]:
+    from selectolax.lexbor import LexborHTMLParser
+
+    tree = LexborHTMLParser(html)
+    title = ''
+    for node in tree.css('title'):
+        parent = node.parent
+        while parent is not None and parent.tag not in _BOILERPLATE_TAGS:
+            parent = parent.parent
+        if parent is None or parent.tag == 'head':
+            title = node.text(strip=True)
+            break
+    tree.strip_tags(list(_BOILERPLATE_TAGS))
+    root = tree.body or tree.root
+    if root is None:
+        return title, ''
+    text = []
+    for node in root.traverse(include_text=True):
+        if node.tag == '-text':
+            text.append(node.text(deep=False) or '')
+        elif node.tag in _BLOCK_TAGS:
+            text.append('\n')
+    return title, ''.join(text)
+
+
+def _html_to_text_lxml(html: str) -> Tuple[str, str]:
+    import lxml.html
+    from lxml import etree
+
+    try:
+        root = lxml.html.document_fromstring(html)
+    except etree.ParserError:  # nothing but whitespace or comments
+        return '', ''
+    outside = ' or '.join(f'self::{x}' for x in _BOILERPLATE_TAGS
+                          if x != 'head')
+    titles = root.xpath(f'//title[not(ancestor::*[{outside}])]')
+    title = (titles[0].text_content() if titles else '').strip()
+    for el in root.xpath('|'.join(f'//{x}' for x in _BOILERPLATE_TAGS)):
+        el.drop_tree()  # keeps the text that follows it
+    text = []
+    for event, el in etree.iterwalk(root, events=('start', 'end')):
+        is_element = isinstance(el.tag, str)  # not a comment
+        if event == 'start':
+            if el.tag in _BLOCK_TAGS:
+                text.append('\n')
+            if is_element and el.text:
+                text.append(el.text)
+        else:
+            if el.tag in _BLOCK_TAGS:
+                text.append('\n')
+            if el.tail and el is not root:
+                text.append(el.tail)
+    return title, ''.join(text)
+
+
+class _TextExtractor(HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = ''
+        self.text = []
+        self._skip = []  # the open boilerplate elements
+        self._in_title = False
+        self._title_done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title' and not self._title_done and all(
+                x == 'head' for x in self._skip):
+            self._in_title = True
+        elif tag in _BOILERPLATE_TAGS:
+            self._skip.append(tag)
+        elif tag in _BLOCK_TAGS and not self._skip:
+            self.text.append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in _BLOCK_TAGS and not self._skip:
+            self.text.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self._in_title:
+            self._in_title = False
+            self._title_done = True
+        elif tag in self._skip:
+            # Also closes the elements left open within it.
+            del self._skip[len(self._skip) - self._skip[::-1].index(tag) - 1:]
+        elif tag in _BLOCK_TAGS and not self._skip:
+            self.text.append('\n')
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif not self._skip:
+            self.text.append(data)
+
+
+def _html_to_text_stdlib(html: str) -> Tuple[str, str]:
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return parser.title.strip(), ''.join(parser.text)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_html_to_text() -> Callable[[str], Tuple[str, str]]:
+    # The fastest parser installed; html.parser is always there.
+    for module, fn in (('selectolax.lexbor', _html_to_text_selectolax),
+                       ('lxml.html', _html_to_text_lxml)):
+        try:
+            importlib.import_module(module)
+            return fn
+        except ImportError:
+            continue
+    return _html_to_text_stdlib
+
+
+def parse_html(html: str, source: str = '') -> List[Dict]:
+    """Parses an HTML document in memory into pages of text.
 
-    loader = BSHTMLLoader(path, open_encoding='utf-8')
-    pages = loader.load_and_split()
-    res = [{
-        'page_content': pre_process_html(page.page_content),
-        'metadata': page.metadata
-    } for page in pages]
-    return res
+    The text of boilerplate such as scripts, navigation bars and footers is
+    left out, and the rest is split into pages of at most CHUNK_SIZE
+    characters, each with the `source` and the title of the document.
+    """
+    title, text = _get_html_to_text()(html)
+    text = '\n'.join(' '.join(line.split()) for line in text.splitlines())
+    return [{
+        'page_content': chunk,
+        'metadata': {
+            'source': source,
+            'title': title
+        }
+    } for chunk in split_text(pre_process_html(text).strip())]
@@ -1,15 +1,28 @@
+import hashlib
+import os
 import re
 import socket
 import sys
+import threading
 import traceback
-
-import jieba
-import json5
-import tiktoken
-from jieba import analyse
+from collections import Counter, OrderedDict
+from typing import Dict, List
 
 from qwen_agent.log import logger
 
+# jieba, tiktoken and json5 are imported where they are used, as importing
+# them (jieba.analyse alone takes ~1s) would slow down the start of every
+# process that imports qwen_agent.
+
+# Where jieba caches its prefix dictionary, which takes ~1s to build. Its
+# default, the system temp dir, does not survive reboots or tmp cleaners.
+JIEBA_CACHE_DIR = os.getenv(
+    'QWEN_AGENT_JIEBA_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'qwen_agent'))
+
+_JIEBA_LOCK = threading.Lock()
+_jieba_initialized = False
+
 
 def get_local_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -43,10 +56,80 @@ def save_text_to_file(path, text):
         return ex
 
 
+_TOKENIZER = None
+_TOKENIZER_LOCK = threading.Lock()
+
+
+def get_tokenizer():
+    global _TOKENIZER
+    if _TOKENIZER is None:
+        with _TOKENIZER_LOCK:
+            if _TOKENIZER is None:
+                import tiktoken
+                _TOKENIZER = tiktoken.get_encoding('cl100k_base')
+    return _TOKENIZER
+
+
+class _TokenCountCache:
+    """A thread-safe LRU cache of token counts, keyed by content hash."""
+
+    def __init__(self, maxsize: int = 65536):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        return hashlib.md5(text.encode('utf-8')).digest()
+
+    def get(self, key: bytes):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: bytes, value: int):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+_token_count_cache = _TokenCountCache()
+
+
 def count_tokens(text):
-    encoding = tiktoken.get_encoding('cl100k_base')
-    tokens = encoding.encode(text)
-    return len(tokens)
+    key = _token_count_cache.key(text)
+    num = _token_count_cache.get(key)
+    if num is None:
+        num = len(get_tokenizer().encode(text))
+        _token_count_cache.put(key, num)
+    return num
+
+
+def count_tokens_batch(texts: List[str], num_threads: int = 8) -> List[int]:
+    keys = [_token_count_cache.key(x) for x in texts]
+    nums = [_token_count_cache.get(k) for k in keys]
+    missing = [i for i, num in enumerate(nums) if num is None]
+    if missing:
+        tokens = get_tokenizer().encode_batch([texts[i] for i in missing],
+                                              num_threads=num_threads)
+        for i, x in zip(missing, tokens):
+            nums[i] = len(x)
+            _token_count_cache.put(keys[i], nums[i])
+    return nums
+
+
+def truncate_tokens(text: str, max_token: int) -> str:
+    """Keeps the longest prefix of the text that fits in max_token tokens."""
+    if max_token <= 0:
+        return ''
+    tokens = get_tokenizer().encode(text)
+    if len(tokens) <= max_token:
+        return text
+    return get_tokenizer().decode(tokens[:max_token])
 
 
 ignore_words = [
@@ -58,9 +141,30 @@ ignore_words = [
 ]
 
 
+def initialize_jieba():
+    """Loads the prefix dictionary of jieba, from its cache on disk if any.
+
+    Called on first use; servers call it at startup, in the background.
+    """
+    global _jieba_initialized
+    import jieba
+
+    if not _jieba_initialized:
+        with _JIEBA_LOCK:
+            if not _jieba_initialized:
+                try:
+                    os.makedirs(JIEBA_CACHE_DIR, exist_ok=True)
+                    jieba.dt.tmp_dir = JIEBA_CACHE_DIR
+                except OSError:
+                    print_traceback()  # falls back to the temp dir
+                jieba.initialize()
+                _jieba_initialized = True
+    return jieba
+
+
 def get_split_word(text):
     text = text.lower()
-    _wordlist = jieba.lcut(text.strip())
+    _wordlist = initialize_jieba().lcut(text.strip())
     wordlist = []
     for x in _wordlist:
         if x in ignore_words:
@@ -69,7 +173,29 @@ def get_split_word(text):
     return wordlist
 
 
+def get_term_freq(text) -> Dict[str, int]:
+    return dict(Counter(get_split_word(text)))
+
+
+def precompute_page_stats(pages: List[Dict]) -> List[Dict]:
+    """Adds the fields that retrieval needs to each page, in place.
+
+    These are `token_num`, `terms` (term frequencies) and `content_hash`, so
+    that they are computed once at ingest time instead of at every query.
+    """
+    token_nums = count_tokens_batch([page['page_content'] for page in pages])
+    for page, token_num in zip(pages, token_nums):
+        text = page['page_content']
+        page['token_num'] = token_num
+        page['terms'] = get_term_freq(text)
+        page['content_hash'] = hashlib.md5(text.encode('utf-8')).hexdigest()
+    return pages
+
+
 def get_key_word(text):
+    initialize_jieba()
+    from jieba import analyse
+
     text = text.lower()
     _wordlist = analyse.extract_tags(text)
     wordlist = []
@@ -106,6 +232,8 @@ def extract_obs(text):
 
 
 def extract_code(text):
+    import json5
+
     # Match triple backtick blocks first
     triple_match = re.search(r'```[^\n]*\n(.+?)```', text, re.DOTALL)
     if triple_match:
@@ -138,6 +266,8 @@ def parse_latest_plugin_call(text):
 
 # TODO: Say no to these ugly if statements.
 def format_answer(text):
+    import json5
+
     action, action_input, output = parse_latest_plugin_call(text)
     if 'code_interpreter' in text:
         rsp = ''
@@ -1,29 +1,43 @@
 import json
 import os
+import threading
 from pathlib import Path
 
 import add_qwen_libs  # NOQA
 import gradio as gr
 import jsonlines
+from record_store import RecordStore
 from schema import GlobalConfig
+from utils import coalesce_updates
 
 from qwen_agent.actions import RetrievalQA
 from qwen_agent.llm import get_chat_model
 from qwen_agent.log import logger
-from qwen_agent.memory import Memory
+from qwen_agent.memory import InvertedIndex, Memory
+from qwen_agent.utils.utils import initialize_jieba
 
 # Read config
 with open(Path(__file__).resolve().parent / 'server_config.json', 'r') as f:
     server_config = json.load(f)
     server_config = GlobalConfig(**server_config)
 
-llm = get_chat_model(model=server_config.server.llm,
-                     api_key=server_config.server.api_key,
-                     model_server=server_config.server.model_server)
+llm = get_chat_model(
+    model=server_config.server.llm,
+    api_key=server_config.server.api_key,
+    model_server=server_config.server.model_server,
+    cache_file=os.path.join(server_config.path.cache_root, 'llm_cache.db')
+    if server_config.server.llm_cache else None,
+    cache_ttl=server_config.server.llm_cache_ttl)
+llm.declare_capabilities(server_config.server.capabilities)
 
-mem = Memory()
+mem = Memory(
+    index=InvertedIndex(os.path.join(server_config.path.cache_root, 'index')))
 
-cache_file = os.path.join(server_config.path.cache_root, 'browse.jsonl')
+cache_file = os.path.join(server_config.path.cache_root, 'browse.db')
+store = RecordStore(cache_file)
+
+# Load jieba while the server starts, rather than on the first request.
+threading.Thread(target=initialize_jieba, daemon=True).start()
 cache_file_popup_url = os.path.join(server_config.path.cache_root,
                                     'popup_url.jsonl')
 
@@ -64,37 +78,29 @@ def set_page_url():
     logger.info('The current access page is: ' + PAGE_URL[-1])
 
 
+@coalesce_updates
 def bot(history):
     set_page_url()
     if not history:
         yield history
     else:
-        now_page = None
         _ref = ''
-        if not os.path.exists(cache_file):
-            gr.Info("Please add this page to Qwen's Reading List first!")
+        now_page = store.get(PAGE_URL[-1])
+        if not now_page:
+            gr.Info(
+                "This page has not yet been added to the Qwen's reading list!")
+        elif not now_page['raw']:
+            gr.Info('Please wait, Qwen is analyzing this page...')
         else:
-            for line in jsonlines.open(cache_file):
-                if line['url'] == PAGE_URL[-1]:
-                    now_page = line
-
-            if not now_page:
-                gr.Info(
-                    "This page has not yet been added to the Qwen's reading list!"
-                )
-            elif not now_page['raw']:
-                gr.Info('Please wait, Qwen is analyzing this page...')
+            _ref_list = mem.get(history[-1][0], [now_page],
+                                llm=llm,
+                                stream=False,
+                                max_token=server_config.server.max_ref_token)
+            if _ref_list:
+                _ref = '\n'.join(
+                    json.dumps(x, ensure_ascii=False) for x in _ref_list)
             else:
-                _ref_list = mem.get(
-                    history[-1][0], [now_page],
-                    llm=llm,
-                    stream=False,
-                    max_token=server_config.server.max_ref_token)
-                if _ref_list:
-                    _ref = '\n'.join(
-                        json.dumps(x, ensure_ascii=False) for x in _ref_list)
-                else:
-                    _ref = ''
+                _ref = ''
 
         agent = RetrievalQA(stream=True, llm=llm)
         history[-1][1] = ''
@@ -106,26 +112,11 @@ def bot(history):
 
         # save history
         if now_page:
-            now_page['session'] = history
-            lines = []
-            for line in jsonlines.open(cache_file):
-                if line['url'] != PAGE_URL[-1]:
-                    lines.append(line)
-
-            lines.append(now_page)
-            with jsonlines.open(cache_file, mode='w') as writer:
-                for new_line in lines:
-                    writer.write(new_line)
+            store.set_session(PAGE_URL[-1], history)
 
 
 def load_history_session(history):
-    now_page = None
-    if not os.path.exists(cache_file):
-        gr.Info("Please add this page to Qwen's Reading List first!")
-        return []
-    for line in jsonlines.open(cache_file):
-        if line['url'] == PAGE_URL[-1]:
-            now_page = line
+    now_page = store.get(PAGE_URL[-1])
     if not now_page:
         gr.Info("Please add this page to Qwen's Reading List first!")
         return []
@@ -136,23 +127,7 @@ def load_history_session(history):
 
 
 def clear_session():
-    if not os.path.exists(cache_file):
-        return None
-    now_page = None
-    lines = []
-    for line in jsonlines.open(cache_file):
-        if line['url'] == PAGE_URL[-1]:
-            now_page = line
-        else:
-            lines.append(line)
-    if not now_page:
-        return None
-    now_page['session'] = []
-    lines.append(now_page)
-    with jsonlines.open(cache_file, mode='w') as writer:
-        for new_line in lines:
-            writer.write(new_line)
-
+    store.set_session(PAGE_URL[-1], [])
     return None
 
 
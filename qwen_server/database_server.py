@@ -1,26 +1,36 @@
 import json
-import multiprocessing
 import os
 from pathlib import Path
 
 import add_qwen_libs  # NOQA
 import jsonlines
 import uvicorn
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 
 from qwen_agent.log import logger
 from qwen_agent.utils.utils import get_local_ip
+from qwen_server.ingestion import IngestionPool
+from qwen_server.record_store import RecordStore
 from qwen_server.schema import GlobalConfig
-from qwen_server.utils import extract_and_cache_document
 
 # Read config
 with open(Path(__file__).resolve().parent / 'server_config.json', 'r') as f:
     server_config = json.load(f)
     server_config = GlobalConfig(**server_config)
 
+cache_file = os.path.join(server_config.path.cache_root, 'browse.db')
+store = RecordStore(cache_file)
+ingestion = IngestionPool(cache_file,
+                          server_config.path.cache_root,
+                          max_workers=server_config.server.ingest_workers,
+                          max_pending=server_config.server.ingest_queue_size)
+
+# Seconds after which a client turned away by a full queue should retry.
+RETRY_AFTER = 5
+
 app = FastAPI()
 
 logger.info(get_local_ip())
@@ -40,6 +50,17 @@ app.add_middleware(
     allow_headers=['*'],
 )
 
+
+@app.on_event('startup')
+def start_ingestion():
+    ingestion.prewarm()
+
+
+@app.on_event('shutdown')
+def shutdown_ingestion():
+    ingestion.shutdown()
+
+
 app.mount('/static',
           StaticFiles(directory=server_config.path.code_interpreter_ws),
           name='static')
@@ -55,22 +76,9 @@ def update_pop_url(data, cache_file_popup_url):
     return response
 
 
-def change_checkbox_state(text, cache_file):
-    if not os.path.exists(cache_file):
-        return {'result': 'no file'}
-    lines = []
-    for line in jsonlines.open(cache_file):
-        if line['url'] == text[3:]:
-            if line['checked']:
-                line['checked'] = False
-            else:
-                line['checked'] = True
-        lines.append(line)
-
-    with jsonlines.open(cache_file, mode='w') as writer:
-        for new_line in lines:
-            writer.write(new_line)
-
+def change_checkbox_state(text):
+    if not store.toggle_checked(text[3:]):
+        return {'result': 'no record'}
     return {'result': 'changed'}
 
 
@@ -81,17 +89,17 @@ async def web_listening(request: Request):
 
     cache_file_popup_url = os.path.join(server_config.path.cache_root,
                                         'popup_url.jsonl')
-    cache_file = os.path.join(server_config.path.cache_root, 'browse.jsonl')
 
     if msg_type == 'change_checkbox':
-        rsp = change_checkbox_state(data['ckid'], cache_file)
+        rsp = change_checkbox_state(data['ckid'])
     elif msg_type == 'cache':
-        cache_obj = multiprocessing.Process(
-            target=extract_and_cache_document,
-            args=(data, cache_file, server_config.path.cache_root))
-        cache_obj.start()
-        # rsp = cache_data(data, cache_file)
-        rsp = 'caching'
+        job = ingestion.submit(data)
+        if job is None:
+            # Backpressure: the client is to send the page again later.
+            return JSONResponse(content={'result': 'busy'},
+                                status_code=429,
+                                headers={'Retry-After': str(RETRY_AFTER)})
+        rsp = {'result': 'caching', 'job': job}
     elif msg_type == 'pop_url':
         # What a misleading name! pop_url actually means add_url. pop is referring to the pop_up ui.
         rsp = update_pop_url(data, cache_file_popup_url)
@@ -101,6 +109,19 @@ async def web_listening(request: Request):
     return JSONResponse(content=rsp)
 
 
+@app.get('/jobs')
+def list_jobs():
+    return JSONResponse(content=ingestion.list_jobs())
+
+
+@app.get('/jobs/{job_id}')
+def get_job(job_id: str):
+    job = ingestion.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail='no such job')
+    return JSONResponse(content=job)
+
+
 if __name__ == '__main__':
     uvicorn.run(app='database_server:app',
                 host=server_config.server.server_host,
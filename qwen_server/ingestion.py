@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+
+from qwen_agent.log import logger
+from qwen_agent.utils.utils import print_traceback
+from qwen_server.utils import extract_and_cache_document
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _warm_up(num_workers: int):
+    # Runs once in every worker, so that no job pays for these imports.
+    try:
+        import pypdf  # NOQA
+
+        from qwen_agent.utils import doc_parser
+        from qwen_agent.utils.doc_parser import parse_html
+        from qwen_agent.utils.utils import initialize_jieba
+        if not os.getenv('QWEN_AGENT_PDF_WORKERS'):
+            # Every worker parses PDFs on a pool of its own, so they share
+            # the CPUs between them.
+            num_cpus = doc_parser.PDF_WORKERS
+            doc_parser.PDF_WORKERS = max(num_cpus // num_workers, 1)
+        parse_html('<p></p>')  # imports the HTML parser
+        initialize_jieba()
+    except Exception:
+        print_traceback()
+
+
+class IngestionPool:
+    """Caches the documents sent by the browser in a few warm processes.
+
+    A document is cached by a job, which waits in a queue of at most
+    `max_pending` jobs, queued or running, for one of `max_workers` worker
+    processes. A document whose url already has a job in flight is not
+    queued again; that job is returned instead. When the queue is full,
+    `submit` refuses the job, so that the caller can ask the client to retry
+    later rather than pile up work. The last `max_history` finished jobs are
+    kept, so that their status can still be looked up.
+
+    If a worker dies, e.g. of a segfault in a parser or of OOM, the jobs it
+    broke fail, and the workers are started afresh for the next job.
+    """
+
+    def __init__(self,
+                 db_file: str,
+                 cache_root: str,
+                 max_workers: int = 2,
+                 max_pending: int = 32,
+                 max_history: int = 256):
+        self.db_file = db_file
+        self.cache_root = cache_root
+        self.max_pending = max_pending
+        self.max_history = max_history
+        self.max_workers = max_workers
+        self._executor = self._new_executor()
+        self._jobs: 'OrderedDict[str, Dict]' = OrderedDict()  # by id
+        self._futures: Dict[str, Future] = {}
+        self._in_flight: Dict[str, str] = {}  # url -> job id
+        self._lock = threading.Lock()
+
+    def submit(self, data: Dict) -> Optional[Dict]:
+        """Queues a document, returns its job, or None if the queue is full."""
+        with self._lock:
+            job_id = self._in_flight.get(data['url'])
+            if job_id is not None:
+                return self._status(job_id)
+            if len(self._in_flight) >= self.max_pending:
+                return None
+            future = self._submit(extract_and_cache_document, data,
+                                  self.db_file, self.cache_root)
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                'id': job_id,
+                'url': data['url'],
+                'status': QUEUED,
+                'submitted': time.time(),
+                'finished': None,
+                'error': None,
+            }
+            self._in_flight[data['url']] = job_id
+            self._futures[job_id] = future
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            if job_id not in self._jobs:
+                return None
+            return self._status(job_id)
+
+    def list_jobs(self) -> List[Dict]:
+        """Returns the jobs in flight and the recent ones, oldest first."""
+        with self._lock:
+            return [self._status(x) for x in self._jobs]
+
+    def prewarm(self):
+        """Starts the workers, which then import the parsers."""
+        with self._lock:
+            for _ in range(self.max_workers):
+                self._submit(int)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(self.max_workers,
+                                   initializer=_warm_up,
+                                   initargs=(self.max_workers, ))
+
+    def _submit(self, fn, *args) -> Future:
+        # Must hold self._lock.
+        try:
+            return self._executor.submit(fn, *args)
+        except BrokenProcessPool:
+            logger.warning('An ingestion worker died, restarting the workers')
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._new_executor()
+            return self._executor.submit(fn, *args)
+
+    def _status(self, job_id: str) -> Dict:
+        # Must hold self._lock.
+        job = dict(self._jobs[job_id])
+        future = self._futures.get(job_id)
+        if future is not None and future.running():
+            job['status'] = RUNNING
+        return job
+
+    def _finish(self, job_id: str, future: Future):
+        if future.cancelled():
+            status, error = FAILED, 'cancelled'
+        elif future.exception() is not None:
+            status, error = FAILED, repr(future.exception())
+        elif future.result() == 'failed':
+            status, error = FAILED, 'could not parse the document'
+        else:
+            status, error = DONE, None
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(status=status, finished=time.time(), error=error)
+            if error is not None:
+                logger.error(f'Failed to cache {job["url"]}: {error}')
+            self._futures.pop(job_id, None)
+            if self._in_flight.get(job['url']) == job_id:
+                del self._in_flight[job['url']]
+            finished = [x for x in self._jobs if x not in self._futures]
+            for x in finished[:max(len(finished) - self.max_history, 0)]:
+                del self._jobs[x]
@@ -0,0 +1,351 @@
+import bisect
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import jsonlines
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    url TEXT PRIMARY KEY,
+    time TEXT NOT NULL,
+    type TEXT NOT NULL,
+    extract TEXT NOT NULL,
+    topic TEXT NOT NULL,
+    checked INTEGER NOT NULL,
+    session TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_time ON records (time);
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT NOT NULL,
+    page_id INTEGER NOT NULL,
+    page TEXT NOT NULL,
+    PRIMARY KEY (url, page_id)
+);
+"""
+
+# Applied in order to bring a database up to date. The number of migrations
+# applied to it is kept in its PRAGMA user_version.
+_MIGRATIONS = [
+    # 1: The pages parsed from a document are kept once per distinct content,
+    # under the hash of the content, and shared by the records (urls) with
+    # that content. Records cached before keep their pages in `pages`.
+    [
+        'ALTER TABLE records ADD COLUMN content_hash TEXT',
+        'CREATE INDEX IF NOT EXISTS records_content_hash '
+        'ON records (content_hash)',
+        """CREATE TABLE IF NOT EXISTS parses (
+            content_hash TEXT PRIMARY KEY,
+            extract TEXT NOT NULL,
+            complete INTEGER NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS parsed_pages (
+            content_hash TEXT NOT NULL,
+            page_id INTEGER NOT NULL,
+            page TEXT NOT NULL,
+            PRIMARY KEY (content_hash, page_id)
+        )""",
+    ],
+]
+
+_RECORD_FIELDS = ('url, time, type, extract, topic, checked, session, '
+                  'content_hash')
+_META_FIELDS = 'rowid, url, time, type, extract, topic, checked'
+
+
+class RecordStore:
+    """The browsing records, kept in SQLite instead of one big jsonl file.
+
+    A record's metadata lives in `records` (primary key `url`, secondary index
+    on `time`), and its parsed pages, which make up nearly all of the bytes,
+    live in `pages`. Flipping a checkbox or saving a chat turn is thus a point
+    update rather than a rewrite of every cached document. The database runs
+    in WAL mode, so the server processes can read while one of them writes.
+
+    A record with a `content_hash` shares the pages parsed from its content
+    with the other records of the same content, through `parses` and
+    `parsed_pages`, so that an unchanged or duplicate document is linked to
+    its parse instead of being parsed again.
+
+    Listing and date-range filtering are answered from an in-memory index of
+    the metadata, which is reloaded only when the database has changed.
+    """
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+        self._migrate()
+
+    def put(self, record: Dict):
+        """Inserts or replaces a record, together with its pages."""
+        conn = self._conn()
+        with conn:
+            self._put(conn, record)
+        self._local.meta = None
+
+    def put_metadata(self, record: Dict):
+        """Inserts or replaces a record, without pages of its own.
+
+        A record with a `content_hash` gets the pages of that parse.
+        """
+        conn = self._conn()
+        with conn:
+            self._put_metadata(conn, record)
+        self._local.meta = None
+
+    def get(self, url: str) -> Optional[Dict]:
+        row = self._conn().execute(
+            f'SELECT {_RECORD_FIELDS} FROM records WHERE url = ?',
+            (url, )).fetchone()
+        if row is None:
+            return None
+        if row[7]:
+            return self._to_record(row, self.get_parsed_pages(row[7]))
+        return self._to_record(row, self._get_own_pages(url))
+
+    def get_pages(self, url: str) -> List[Dict]:
+        row = self._conn().execute(
+            'SELECT content_hash FROM records WHERE url = ?',
+            (url, )).fetchone()
+        if row is not None and row[0]:
+            return self.get_parsed_pages(row[0])
+        return self._get_own_pages(url)
+
+    def get_content_hash(self, url: str) -> Optional[str]:
+        return self._get_content_hash(self._conn(), url)
+
+    def get_parse(self, content_hash: str) -> Optional[Dict]:
+        """Returns the extract of a parse and whether it is complete."""
+        row = self._conn().execute(
+            'SELECT extract, complete FROM parses WHERE content_hash = ?',
+            (content_hash, )).fetchone()
+        if row is None:
+            return None
+        return {'extract': row[0], 'complete': bool(row[1])}
+
+    def put_parse(self, content_hash: str, extract: str):
+        """Starts a parse, to which pages are then added as they are parsed."""
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO parses (content_hash, extract, complete) '
+                'VALUES (?, ?, 0)', (content_hash, extract))
+
+    def put_parsed_pages(self,
+                         content_hash: str,
+                         pages: List[Dict],
+                         start: int = 0):
+        """Adds the pages numbered from `start` to a parse."""
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO parsed_pages '
+                '(content_hash, page_id, page) VALUES (?, ?, ?)',
+                [(content_hash, i, json.dumps(page, ensure_ascii=False))
+                 for i, page in enumerate(pages, start)])
+
+    def complete_parse(self, content_hash: str):
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'UPDATE parses SET complete = 1 WHERE content_hash = ?',
+                (content_hash, ))
+
+    def get_parsed_pages(self, content_hash: str) -> List[Dict]:
+        rows = self._conn().execute(
+            'SELECT page FROM parsed_pages WHERE content_hash = ? '
+            'ORDER BY page_id', (content_hash, ))
+        return [json.loads(row[0]) for row in rows]
+
+    def discard_parse(self, content_hash: str):
+        """Deletes a parse, unless a record still links to it."""
+        conn = self._conn()
+        with conn:
+            self._gc_parse(conn, content_hash)
+
+    def list_records(self,
+                     times: Optional[List[str]] = None,
+                     checked: Optional[bool] = None) -> List[Dict]:
+        """Returns the metadata of the records browsed within the times.
+
+        The records are in the order in which they were cached, and carry
+        neither pages nor session.
+        """
+        meta, meta_times = self._metadata()
+        lo, hi = 0, len(meta)
+        if times:
+            lo = bisect.bisect_left(meta_times, times[0])
+            hi = bisect.bisect_right(meta_times, times[1])
+        res = [
+            x for x in meta[lo:hi]
+            if checked is None or x['checked'] == checked
+        ]
+        res.sort(key=lambda x: x['rowid'])
+        return res
+
+    def query(self,
+              times: Optional[List[str]] = None,
+              checked: Optional[bool] = None) -> List[Dict]:
+        """Returns the full records browsed within [times[0], times[1]].
+
+        The pages are only loaded for the records that pass the filters.
+        """
+        res = []
+        for x in self.list_records(times=times, checked=checked):
+            record = self.get(x['url'])
+            if record is not None:  # deleted in the meantime
+                res.append(record)
+        return res
+
+    def delete(self, url: str):
+        conn = self._conn()
+        with conn:
+            content_hash = self._get_content_hash(conn, url)
+            conn.execute('DELETE FROM records WHERE url = ?', (url, ))
+            conn.execute('DELETE FROM pages WHERE url = ?', (url, ))
+            self._gc_parse(conn, content_hash)
+        self._local.meta = None
+
+    def toggle_checked(self, url: str) -> bool:
+        """Flips the checkbox of a record, returns False if there is none."""
+        conn = self._conn()
+        with conn:
+            cur = conn.execute(
+                'UPDATE records SET checked = 1 - checked WHERE url = ?',
+                (url, ))
+        self._local.meta = None
+        return cur.rowcount > 0
+
+    def set_session(self, url: str, session: list):
+        conn = self._conn()
+        with conn:
+            conn.execute('UPDATE records SET session = ? WHERE url = ?',
+                         (json.dumps(session, ensure_ascii=False), url))
+
+    def migrate_from_jsonl(self, jsonl_file: str) -> int:
+        """Imports the records of a legacy browse.jsonl, then renames it."""
+        if not os.path.exists(jsonl_file):
+            return 0
+        num = 0
+        conn = self._conn()
+        with conn:
+            for record in jsonlines.open(jsonl_file):
+                self._put(conn, record)
+                num += 1
+        self._local.meta = None
+        os.replace(jsonl_file, jsonl_file + '.migrated')
+        return num
+
+    def _metadata(self) -> Tuple[List[Dict], List[str]]:
+        """Returns the metadata sorted by time, and the sorted times."""
+        conn = self._conn()
+        # data_version changes whenever another connection commits.
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if self._local.meta is None or self._local.meta_version != version:
+            rows = conn.execute(f'SELECT {_META_FIELDS} FROM records '
+                                'ORDER BY time, rowid').fetchall()
+            self._local.meta = [{
+                'rowid': row[0],
+                'url': row[1],
+                'time': row[2],
+                'type': row[3],
+                'extract': row[4],
+                'topic': row[5],
+                'checked': bool(row[6]),
+            } for row in rows]
+            self._local.meta_times = [x['time'] for x in self._local.meta]
+            self._local.meta_version = version
+        return self._local.meta, self._local.meta_times
+
+    def _get_own_pages(self, url: str) -> List[Dict]:
+        rows = self._conn().execute(
+            'SELECT page FROM pages WHERE url = ? ORDER BY page_id', (url, ))
+        return [json.loads(row[0]) for row in rows]
+
+    def _migrate(self):
+        conn = self._conn()
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= len(
+                _MIGRATIONS):
+            return
+        # Taking the write lock first, so that only one process migrates.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for migration in _MIGRATIONS[version:]:
+                for statement in migration:
+                    conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {len(_MIGRATIONS)}')
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared across threads or processes.
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.meta = None
+        return self._local.conn
+
+    @classmethod
+    def _put(cls, conn: sqlite3.Connection, record: Dict):
+        cls._put_metadata(conn, record)
+        if not record.get('content_hash'):
+            conn.executemany(
+                'INSERT INTO pages (url, page_id, page) VALUES (?, ?, ?)',
+                [(record['url'], i, json.dumps(page, ensure_ascii=False))
+                 for i, page in enumerate(record['raw'])])
+
+    @classmethod
+    def _put_metadata(cls, conn: sqlite3.Connection, record: Dict):
+        old_hash = cls._get_content_hash(conn, record['url'])
+        session = json.dumps(record['session'], ensure_ascii=False)
+        values = (record['url'], record['time'],
+                  record['type'], record['extract'], record['topic'],
+                  int(record['checked']), session, record.get('content_hash'))
+        conn.execute(
+            f'INSERT OR REPLACE INTO records ({_RECORD_FIELDS}) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', values)
+        conn.execute('DELETE FROM pages WHERE url = ?', (record['url'], ))
+        if old_hash != record.get('content_hash'):
+            cls._gc_parse(conn, old_hash)
+
+    @staticmethod
+    def _get_content_hash(conn: sqlite3.Connection, url: str) -> Optional[str]:
+        row = conn.execute('SELECT content_hash FROM records WHERE url = ?',
+                           (url, )).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _gc_parse(conn: sqlite3.Connection, content_hash: Optional[str]):
+        # Deletes the parse if no record links to it any more.
+        if not content_hash:
+            return
+        if conn.execute('SELECT 1 FROM records WHERE content_hash = ?',
+                        (content_hash, )).fetchone():
+            return
+        conn.execute('DELETE FROM parses WHERE content_hash = ?',
+                     (content_hash, ))
+        conn.execute('DELETE FROM parsed_pages WHERE content_hash = ?',
+                     (content_hash, ))
+
+    @staticmethod
+    def _to_record(row, raw: List[Dict]) -> Dict:
+        return {
+            'url': row[0],
+            'time': row[1],
+            'type': row[2],
+            'raw': raw,
+            'extract': row[3],
+            'topic': row[4],
+            'checked': bool(row[5]),
+            'session': json.loads(row[6]),
+            'content_hash': row[7],
+        }
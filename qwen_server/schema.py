@@ -1,3 +1,5 @@
+from typing import Dict, Optional
+
 from pydantic import BaseModel
 
 
@@ -5,11 +7,16 @@ class Record(BaseModel):
     url: str
     time: str
     type: str
+    # Pages with page_content, metadata, and the token_num, terms and
+    # content_hash added by precompute_page_stats at ingest time.
     raw: list
     extract: str
     topic: str
     checked: bool
     session: list
+    # Hash of the document (PDF bytes or HTML), under which its pages are
+    # stored once for all the urls with the same content.
+    content_hash: Optional[str] = None
 
     def to_dict(self) -> dict:
         return {
@@ -20,7 +27,8 @@ class Record(BaseModel):
             'extract': self.extract,
             'topic': self.topic,
             'checked': self.checked,
-            'session': self.session
+            'session': self.session,
+            'content_hash': self.content_hash
         }
 
 
@@ -41,6 +49,16 @@ class ServerConfig(BaseModel):
     llm: str
     max_ref_token: int
     max_days: int
+    # Answer repeated LLM requests from cache_root/llm_cache.db.
+    llm_cache: bool = False
+    llm_cache_ttl: Optional[float] = None  # seconds, None for no expiry
+    # Capabilities of the llm known in advance, e.g. {"function_calling":
+    # true}, so that they need not be probed with a request to it.
+    capabilities: Dict[str, bool] = {}
+    # Processes caching the pages sent by the browser, and how many pages may
+    # wait for them before further ones are turned away.
+    ingest_workers: int = 2
+    ingest_queue_size: int = 32
 
     class Config:
         protected_namespaces = ()
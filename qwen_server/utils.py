@@ -1,16 +1,183 @@
+import asyncio
+import contextvars
 import datetime
+import functools
+import hashlib
+import inspect
 import os
+import queue
 import re
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from typing import AsyncIterator, Callable, Dict, Iterator, Optional
 from urllib.parse import unquote, urlparse
 
 import add_qwen_libs  # NOQA
-import jsonlines
 
 from qwen_agent.log import logger
-from qwen_agent.utils.doc_parser import parse_html_bs, parse_pdf_pypdf
-from qwen_agent.utils.utils import print_traceback, save_text_to_file
+from qwen_agent.memory import InvertedIndex
+from qwen_agent.utils.doc_parser import iter_pdf_pages, local_copy, parse_html
+from qwen_agent.utils.utils import precompute_page_stats, print_traceback
+from qwen_server.record_store import RecordStore
 from qwen_server.schema import Record
 
+# While a document is parsed, its pages are written to the store and the index
+# this often (seconds), so that it can be queried before it is fully parsed.
+INGEST_FLUSH_INTERVAL = 1.0
+
+# Streamed updates are sent to the frontend at most this often (seconds).
+STREAM_INTERVAL = 0.05
+
+_END = object()
+_NOTHING = object()
+
+
+class _Raised:
+
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+class _Latest:
+    """Keeps the latest update until it is due to be sent."""
+
+    def __init__(self):
+        self.pending = _NOTHING
+        self.last_sent = 0.0
+
+    def timeout(self) -> Optional[float]:
+        """How long to wait for the next update, None if nothing is pending."""
+        if self.pending is _NOTHING:
+            return None
+        return max(self.last_sent + STREAM_INTERVAL - time.monotonic(), 0)
+
+    def put(self, update) -> bool:
+        """Returns True if the update is due already."""
+        self.pending = update
+        return time.monotonic() - self.last_sent >= STREAM_INTERVAL
+
+    def take(self):
+        update, self.pending = self.pending, _NOTHING
+        self.last_sent = time.monotonic()
+        return update
+
+
+def coalesce_updates(fn: Callable) -> Callable:
+    """Sends the updates yielded by a streaming Gradio handler in batches.
+
+    Gradio re-sends the whole value (e.g. the chat history) on every yield,
+    so yielding once per chunk of a long answer costs bytes quadratic in its
+    length. The handler is instead run ahead of the frontend, and only the
+    latest of the updates it yields within STREAM_INTERVAL is sent. An update
+    is never held back longer than that, even if the handler then stalls,
+    and the last one is always sent.
+    """
+    if inspect.isasyncgenfunction(fn):
+
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            async for update in _acoalesce(fn(*args, **kwargs)):
+                yield update
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        yield from _coalesce(fn(*args, **kwargs))
+
+    return wrapper
+
+
+def _coalesce(updates: Iterator) -> Iterator:
+    q: queue.Queue = queue.Queue()
+    stopped = threading.Event()
+
+    def _produce():
+        try:
+            for update in updates:
+                q.put(update)
+                if stopped.is_set():  # the frontend went away, e.g. Stop
+                    updates.close()
+                    return
+        except BaseException as e:
+            q.put(_Raised(e))
+        q.put(_END)
+
+    threading.Thread(target=_in_this_context(_produce), daemon=True).start()
+    latest = _Latest()
+    try:
+        while True:
+            try:
+                item = q.get(timeout=latest.timeout())
+            except queue.Empty:
+                yield latest.take()
+                continue
+            if item is _END:
+                break
+            if isinstance(item, _Raised):
+                raise item.exc
+            if latest.put(item):
+                yield latest.take()
+        if latest.pending is not _NOTHING:
+            yield latest.take()
+    finally:
+        stopped.set()
+
+
+def _in_this_context(fn: Callable) -> Callable:
+    """Wraps fn to run in another thread with the context of this one.
+
+    gr.Info and gr.Warning find the event to report to in Gradio's context of
+    the thread that runs the handler, which is thread-local in Gradio 3 and
+    in context variables in later versions. Without it, they only log.
+    """
+    ctx = contextvars.copy_context()
+    try:
+        from gradio.context import thread_data
+        local = dict(vars(thread_data))
+    except ImportError:
+        thread_data, local = None, {}
+
+    def run(*args, **kwargs):
+        for k, v in local.items():
+            setattr(thread_data, k, v)
+        return ctx.run(fn, *args, **kwargs)
+
+    return run
+
+
+async def _acoalesce(updates: AsyncIterator) -> AsyncIterator:
+    q: asyncio.Queue = asyncio.Queue()
+
+    async def _produce():
+        try:
+            async for update in updates:
+                q.put_nowait(update)
+        except Exception as e:
+            q.put_nowait(_Raised(e))
+        q.put_nowait(_END)
+
+    task = asyncio.ensure_future(_produce())
+    latest = _Latest()
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(q.get(), latest.timeout())
+            except asyncio.TimeoutError:
+                yield latest.take()
+                continue
+            if item is _END:
+                break
+            if isinstance(item, _Raised):
+                raise item.exc
+            if latest.put(item):
+                yield latest.take()
+        if latest.pending is not _NOTHING:
+            yield latest.take()
+    finally:
+        task.cancel()  # the frontend may have gone away
+
 
 def is_local_path(path):
     if path.startswith('https://') or path.startswith('http://'):
@@ -44,23 +211,142 @@ def sanitize_chrome_file_path(file_path: str) -> str:
     return file_path
 
 
-def extract_and_cache_document(data, cache_file, cache_root):
-    logger.info('Starting cache pages...')
-    if data['url'][-4:] in ['.pdf', '.PDF']:
-        date1 = datetime.datetime.now()
+class _StageTimer:
+    """Adds up the time an ingestion spends in each of its stages."""
 
-        # generate one processing record
-        new_record = Record(url=data['url'],
-                            time='',
-                            type=data['type'],
-                            raw=[],
-                            extract='',
-                            topic='',
-                            checked=False,
-                            session=[]).to_dict()
-        with jsonlines.open(cache_file, mode='a') as writer:
-            writer.write(new_record)
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.seconds: Dict[str, float] = {}
+
+    @contextmanager
+    def __call__(self, stage: str):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - t)
+
+    def add(self, stage: str, seconds: float):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
 
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def __str__(self):
+        stages = ', '.join(f'{k} {v:.2f}s' for k, v in self.seconds.items())
+        return f'{self.elapsed():.2f}s in total ({stages})'
+
+
+def _hash_file(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _link_to_parse(url: str, doc_type: str, content_hash: str,
+                   extract: Optional[str], store: RecordStore,
+                   index: InvertedIndex, timer: _StageTimer) -> bool:
+    """Links a document to the parse of the same content, if there is one.
+
+    This is the case if the document is unchanged since it was last cached,
+    or if it was cached under another url. Returns False if it is new.
+    """
+    parse = store.get_parse(content_hash)
+    if parse is None or not parse['complete']:
+        return False
+    unchanged = store.get_content_hash(url) == content_hash
+    new_record = Record(url=url,
+                        time=str(datetime.date.today()),
+                        type=doc_type,
+                        raw=[],
+                        extract=extract or parse['extract'],
+                        topic='',
+                        checked=True,
+                        session=[],
+                        content_hash=content_hash)
+    with timer('store'):
+        store.put_metadata(new_record.to_dict())
+    if not (unchanged and index.has_document(url)):
+        with timer('index'):
+            # The pages carry their term frequencies, nothing is recomputed.
+            index.add_document(url, store.get_parsed_pages(content_hash))
+    logger.info(f'{url} is {"unchanged" if unchanged else "a duplicate"}, '
+                f'linked to its parse: {timer}')
+    return True
+
+
+def _cache_pdf_pages(url: str, pdf_path: str, source: str, content_hash: str,
+                     extract: str, store: RecordStore, index: InvertedIndex,
+                     timer: _StageTimer) -> int:
+    """Parses a PDF into the store and the index, as its pages come in.
+
+    The record is listed, and its parsed pages can be retrieved, from the
+    first flush on, rather than only once the whole document is parsed.
+    Returns the number of pages.
+    """
+    record = Record(url=url,
+                    time=str(datetime.date.today()),
+                    type='pdf',
+                    raw=[],
+                    extract=extract,
+                    topic='',
+                    checked=True,
+                    session=[],
+                    content_hash=content_hash).to_dict()
+    store.put_parse(content_hash, extract)
+    pages, pending = [], []
+    last_flush = None
+
+    def _flush():
+        nonlocal pending, last_flush
+        with timer('store'):
+            store.put_parsed_pages(content_hash,
+                                   pending,
+                                   start=len(pages) - len(pending))
+            if last_flush is None:
+                store.put_metadata(record)
+        with timer('index'):
+            index.add_document(url, pages)
+        if last_flush is None:
+            logger.info(f'{url} is queryable after {timer.elapsed():.2f}s')
+        pending, last_flush = [], time.monotonic()
+
+    batches = iter_pdf_pages(pdf_path, source=source)
+    while True:
+        # The time the workers spent, and how much of it was waited for.
+        with timer('extract (waited)'):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        new_pages, seconds = batch
+        timer.add('extract (workers)', seconds)
+        with timer('stats'):
+            precompute_page_stats(new_pages)
+        pages.extend(new_pages)
+        pending.extend(new_pages)
+        if last_flush is None or (time.monotonic() - last_flush >=
+                                  INGEST_FLUSH_INTERVAL):
+            _flush()
+    if pending or last_flush is None:
+        _flush()
+    store.complete_parse(content_hash)
+    return len(pages)
+
+
+def extract_and_cache_document(data, db_file, cache_root):
+    """Parses a document into the store and the index.
+
+    Documents are identified by the hash of their content. A document whose
+    content was cached before, under this url or another, is not parsed or
+    indexed again, but linked to the pages parsed then.
+    """
+    logger.info('Starting cache pages...')
+    store = RecordStore(db_file)
+    index = InvertedIndex(os.path.join(cache_root, 'index'))
+    timer = _StageTimer()
+    if data['url'][-4:] in ['.pdf', '.PDF']:
         if data['url'].startswith('https://') or data['url'].startswith(
                 'http://'):
             pdf_path = data['url']
@@ -68,28 +354,50 @@ def extract_and_cache_document(data, cache_file, cache_root):
             parsed_url = urlparse(data['url'])
             pdf_path = unquote(parsed_url.path)
             pdf_path = sanitize_chrome_file_path(pdf_path)
+        extract = pdf_path.split('/')[-1].split('\\')[-1].split('.')[0]
 
+        content_hash = None
         try:
-            pdf_content = parse_pdf_pypdf(pdf_path)
+            with ExitStack() as stack:
+                with timer('download'):
+                    local_path = stack.enter_context(local_copy(pdf_path))
+                with timer('hash'):
+                    content_hash = _hash_file(local_path)
+                if _link_to_parse(data['url'], 'pdf', content_hash, extract,
+                                  store, index, timer):
+                    return 'Cached'
+
+                # generate one processing record
+                new_record = Record(url=data['url'],
+                                    time='',
+                                    type=data['type'],
+                                    raw=[],
+                                    extract='',
+                                    topic='',
+                                    checked=False,
+                                    session=[]).to_dict()
+                store.put(new_record)
+                num_pages = _cache_pdf_pages(data['url'], local_path, pdf_path,
+                                             content_hash, extract, store,
+                                             index, timer)
         except Exception:
             print_traceback()
             # del the processing record
-            lines = []
-            if os.path.exists(cache_file):
-                for line in jsonlines.open(cache_file):
-                    if line['url'] != data['url']:
-                        lines.append(line)
-            with jsonlines.open(cache_file, mode='w') as writer:
-                for new_line in lines:
-                    writer.write(new_line)
+            store.delete(data['url'])
+            index.remove_document(data['url'])
+            if content_hash:
+                store.discard_parse(content_hash)
             return 'failed'
-
-        date2 = datetime.datetime.now()
-        logger.info('Parsing pdf time: ' + str(date2 - date1))
-        data['content'] = pdf_content
-        data['type'] = 'pdf'
-        extract = pdf_path.split('/')[-1].split('\\')[-1].split('.')[0]
+        logger.info(f'Cached {num_pages} pages of {data["url"]}: {timer}')
+        return 'Cached'
     elif data['content'] and data['type'] == 'html':
+        with timer('hash'):
+            content_hash = hashlib.sha256(
+                data['content'].encode('utf-8')).hexdigest()
+        if _link_to_parse(data['url'], 'html', content_hash, None, store,
+                          index, timer):
+            return 'Cached'
+
         new_record = Record(url=data['url'],
                             time='',
                             type=data['type'],
@@ -98,19 +406,26 @@ def extract_and_cache_document(data, cache_file, cache_root):
                             topic='',
                             checked=False,
                             session=[]).to_dict()
-        with jsonlines.open(cache_file, mode='a') as writer:
-            writer.write(new_record)
+        store.put(new_record)
 
         try:
-            tmp_html_file = os.path.join(cache_root, 'tmp.html')
-            save_text_to_file(tmp_html_file, data['content'])
-            data['content'] = parse_html_bs(tmp_html_file)
+            with timer('parse'):
+                data['content'] = parse_html(data['content'],
+                                             source=data['url'])
         except Exception:
             print_traceback()
-        extract = data['content'][0]['metadata']['title']
+            store.delete(data['url'])
+            return 'failed'
+        extract = (data['content'][0]['metadata']['title']
+                   if data['content'] else '')
     else:
         raise NotImplementedError
 
+    with timer('stats'):
+        precompute_page_stats(data['content'])
+    with timer('index'):
+        index.add_document(data['url'], data['content'])
+
     today = datetime.date.today()
     new_record = Record(url=data['url'],
                         time=str(today),
@@ -119,16 +434,15 @@ def extract_and_cache_document(data, cache_file, cache_root):
                         extract=extract,
                         topic='',
                         checked=True,
-                        session=[])
-    lines = []
-    if os.path.exists(cache_file):
-        for line in jsonlines.open(cache_file):
-            if line['url'] != data['url']:
-                lines.append(line)
-    lines.append(new_record.to_dict())  # cache
-    with jsonlines.open(cache_file, mode='w') as writer:
-        for new_line in lines:
-            writer.write(new_line)
+                        session=[],
+                        content_hash=content_hash)
+    with timer('store'):
+        store.put_parse(content_hash, extract)
+        store.put_parsed_pages(content_hash, data['content'])
+        store.complete_parse(content_hash)
+        store.put(new_record.to_dict())  # cache
+    logger.info(f'Cached {len(data["content"])} pages of {data["url"]}: '
+                f'{timer}')
 
     response = 'Cached'
     return response
@@ -1,45 +1,75 @@
+import contextlib
 import datetime
+import functools
+import inspect
 import json
 import os
 import shutil
+import signal
+import threading
 from pathlib import Path
 
 import add_qwen_libs  # NOQA
 import gradio as gr
-import jsonlines
 
 from qwen_agent.actions import (ContinueWriting, ReAct, RetrievalQA,
                                 WriteFromScratch)
-from qwen_agent.actions.function_calling import FunctionCalling
-from qwen_agent.llm import get_chat_model
-from qwen_agent.memory import Memory
-from qwen_agent.tools import call_plugin, list_of_all_functions
+from qwen_agent.actions.function_calling import (FunctionCalling,
+                                                 function_call_message,
+                                                 function_result_messages,
+                                                 get_function_calls)
+from qwen_agent.llm import CachedChatModel, get_chat_model, http_pool
+from qwen_agent.memory import InvertedIndex, Memory
+from qwen_agent.tools import (call_plugins_stream, closing_streams,
+                              list_of_all_functions)
+from qwen_agent.tools.code_interpreter import MAX_KERNELS, prewarm_kernels
 from qwen_agent.utils.utils import (count_tokens, format_answer,
                                     get_last_one_line_context,
-                                    has_chinese_chars, save_text_to_file)
+                                    has_chinese_chars, initialize_jieba,
+                                    save_text_to_file)
+from qwen_server.record_store import RecordStore
 from qwen_server.schema import GlobalConfig
-from qwen_server.utils import extract_and_cache_document
+from qwen_server.utils import coalesce_updates, extract_and_cache_document
 
 # Read config
 with open(Path(__file__).resolve().parent / 'server_config.json', 'r') as f:
     server_config = json.load(f)
     server_config = GlobalConfig(**server_config)
 
-llm = get_chat_model(model=server_config.server.llm,
-                     api_key=server_config.server.api_key,
-                     model_server=server_config.server.model_server)
+llm = get_chat_model(
+    model=server_config.server.llm,
+    api_key=server_config.server.api_key,
+    model_server=server_config.server.model_server,
+    cache_file=os.path.join(server_config.path.cache_root, 'llm_cache.db')
+    if server_config.server.llm_cache else None,
+    cache_ttl=server_config.server.llm_cache_ttl)
+llm.declare_capabilities(server_config.server.capabilities)
+
+mem = Memory(
+    index=InvertedIndex(os.path.join(server_config.path.cache_root, 'index')))
+
+
+def _exit_on_sigterm(sig, _frame):
+    # Exiting rather than being killed lets atexit shut the kernels down.
+    raise SystemExit(128 + sig)
 
-mem = Memory()
 
 app_global_para = {
+    'cache_file': os.path.join(server_config.path.cache_root, 'browse.db'),
+}
+
+# The state of one browser session, as events of several sessions run at once.
+# gr.State gives every session its own deep copy.
+SESSION_PARA = {
     'time': [str(datetime.date.today()),
              str(datetime.date.today())],
-    'cache_file': os.path.join(server_config.path.cache_root, 'browse.jsonl'),
     'messages': [],
     'last_turn_msg_id': [],
     'is_first_upload': True,
 }
 
+store = RecordStore(app_global_para['cache_file'])
+
 DOC_OPTION = 'Document QA'
 CI_OPTION = 'Code Interpreter'
 CODE_FLAG = '/code'
@@ -52,9 +82,9 @@ with open(Path(__file__).resolve().parent / 'js/main.js', 'r') as f:
     js = f.read()
 
 
-def add_text(history, text):
+def add_text(history, text, session_para):
     history = history + [(text, None)]
-    app_global_para['last_turn_msg_id'] = []
+    session_para['last_turn_msg_id'] = []
     return history, gr.update(value='', interactive=False)
 
 
@@ -73,18 +103,18 @@ def rm_text(history):
         return history, gr.update(value='', interactive=False)
 
 
-def chat_clear():
-    app_global_para['messages'] = []
+def chat_clear(session_para):
+    session_para['messages'] = []
     return None, None
 
 
-def chat_clear_last():
-    for index in app_global_para['last_turn_msg_id'][::-1]:
-        del app_global_para['messages'][index]
-    app_global_para['last_turn_msg_id'] = []
+def chat_clear_last(session_para):
+    for index in session_para['last_turn_msg_id'][::-1]:
+        del session_para['messages'][index]
+    session_para['last_turn_msg_id'] = []
 
 
-def add_file(file, chosen_plug):
+def add_file(file, chosen_plug, session_para):
     output_filepath = server_config.path.code_interpreter_ws
     fn = os.path.basename(file.name)
     if chosen_plug == DOC_OPTION and fn[-4:] != '.pdf' and fn[-4:] != '.PDF':
@@ -97,7 +127,7 @@ def add_file(file, chosen_plug):
             os.remove(new_path)
         shutil.move(file.name, output_filepath)
         if chosen_plug == CI_OPTION:
-            app_global_para['is_first_upload'] = True
+            session_para['is_first_upload'] = True
 
         # upload references
         if chosen_plug == DOC_OPTION:
@@ -115,18 +145,16 @@ def add_file(file, chosen_plug):
     return new_path
 
 
-def read_records(file, times=None):
+def read_records(times=None, checked=None):
     lines = []
     if times:
-        for line in jsonlines.open(file):
-            if times[0] <= line['time'] <= times[1]:
-                lines.append(line)
+        lines = store.query(times=times, checked=checked)
     return lines
 
 
-def update_app_global_para(date1, date2):
-    app_global_para['time'][0] = date1
-    app_global_para['time'][1] = date2
+def update_session_para(date1, date2, session_para):
+    session_para['time'][0] = date1
+    session_para['time'][1] = date2
 
 
 def refresh_date():
@@ -138,11 +166,8 @@ def refresh_date():
             gr.update(choices=option, value=str(datetime.date.today())))
 
 
-def update_browser_list():
-    if not os.path.exists(app_global_para['cache_file']):
-        return 'No browsing records'
-    lines = read_records(app_global_para['cache_file'],
-                         times=app_global_para['time'])
+def update_browser_list(session_para):
+    lines = store.list_records(times=session_para['time'])
 
     br_list = [[line['url'], line['extract'], line['checked']]
                for line in lines]
@@ -193,7 +218,9 @@ def choose_plugin(chosen_plugin):
         return gr.update(interactive=False), None
 
 
-def pure_bot(history):
+@coalesce_updates
+async def pure_bot(history):
+    # Runs on the event loop, without holding a thread while the LLM answers.
     if not history:
         yield history
     else:
@@ -203,20 +230,20 @@ def pure_bot(history):
             messages.append({'role': 'user', 'content': chat[0]})
             messages.append({'role': 'assistant', 'content': chat[1]})
         messages.append({'role': 'user', 'content': history[-1][0]})
-        response = llm.chat(messages=messages, stream=True)
-        for chunk in response:
+        async for chunk in llm.astream(messages=messages):
             history[-1][1] += chunk
             yield history
 
 
-def bot(history, upload_file, chosen_plug):
+@coalesce_updates
+def bot(history, upload_file, chosen_plug, session_para, request: gr.Request):
     if not history:
         yield history
     else:
         history[-1][1] = ''
         if chosen_plug == CI_OPTION:  # use code interpreter
             prompt_upload_file = ''
-            if upload_file and app_global_para['is_first_upload']:
+            if upload_file and session_para['is_first_upload']:
                 workspace_dir = server_config.path.code_interpreter_ws
                 file_relpath = os.path.relpath(path=upload_file,
                                                start=workspace_dir)
@@ -224,57 +251,58 @@ def bot(history, upload_file, chosen_plug):
                     prompt_upload_file = f'上传了[文件]({file_relpath})到当前目录，'
                 else:
                     prompt_upload_file = f'Uploaded the [file]({file_relpath}) to the current directory. '
-                app_global_para['is_first_upload'] = False
+                session_para['is_first_upload'] = False
             history[-1][0] = prompt_upload_file + history[-1][0]
             if llm.support_function_calling():
                 message = {'role': 'user', 'content': history[-1][0]}
-                app_global_para['last_turn_msg_id'].append(
-                    len(app_global_para['messages']))
-                app_global_para['messages'].append(message)
+                session_para['last_turn_msg_id'].append(
+                    len(session_para['messages']))
+                session_para['messages'].append(message)
                 while True:
                     functions = [
                         x for x in list_of_all_functions
                         if x['name_for_model'] == 'code_interpreter'
                     ]
-                    rsp = llm.chat_with_functions(app_global_para['messages'],
+                    rsp = llm.chat_with_functions(session_para['messages'],
                                                   functions)
-                    if rsp.get('function_call', None):
+                    calls = get_function_calls(rsp)
+                    if calls:
                         history[-1][1] += rsp['content'].strip() + '\n'
                         yield history
-                        history[-1][1] += (
-                            'Action: ' + rsp['function_call']['name'].strip() +
-                            '\n')
-                        yield history
-                        history[-1][1] += ('Action Input:\n' +
-                                           rsp['function_call']['arguments'] +
-                                           '\n')
-                        yield history
-                        bot_msg = {
-                            'role': 'assistant',
-                            'content': rsp['content'],
-                            'function_call': {
-                                'name': rsp['function_call']['name'],
-                                'arguments': rsp['function_call']['arguments'],
-                            },
-                        }
-                        app_global_para['last_turn_msg_id'].append(
-                            len(app_global_para['messages']))
-                        app_global_para['messages'].append(bot_msg)
-
-                        obs = call_plugin(
-                            rsp['function_call']['name'],
-                            rsp['function_call']['arguments'],
-                        )
-                        func_msg = {
-                            'role': 'function',
-                            'name': rsp['function_call']['name'],
-                            'content': obs,
-                        }
-                        history[-1][1] += 'Observation: ' + obs + '\n'
-                        yield history
-                        app_global_para['last_turn_msg_id'].append(
-                            len(app_global_para['messages']))
-                        app_global_para['messages'].append(func_msg)
+                        session_para['last_turn_msg_id'].append(
+                            len(session_para['messages']))
+                        session_para['messages'].append(
+                            function_call_message(rsp, calls))
+
+                        plugin_calls = [(x['name'], x['arguments'])
+                                        for x in calls]
+                        results = []
+                        with closing_streams(
+                                call_plugins_stream(
+                                    plugin_calls,
+                                    session_id=request.session_hash)
+                        ) as observations:
+                            for call, observation in zip(calls, observations):
+                                history[-1][1] += ('Action: ' +
+                                                   call['name'].strip() + '\n')
+                                yield history
+                                history[-1][1] += ('Action Input:\n' +
+                                                   call['arguments'] + '\n')
+                                yield history
+                                history[-1][1] += 'Observation: '
+                                obs = ''
+                                for chunk in observation:
+                                    obs += chunk
+                                    history[-1][1] += chunk
+                                    yield history
+                                history[-1][1] += '\n'
+                                yield history
+                                results.append(obs)
+                        for func_msg in function_result_messages(
+                                rsp, calls, results):
+                            session_para['last_turn_msg_id'].append(
+                                len(session_para['messages']))
+                            session_para['messages'].append(func_msg)
                     else:
                         bot_msg = {
                             'role': 'assistant',
@@ -285,9 +313,9 @@ def bot(history, upload_file, chosen_plug):
                         # history[-1][1] += tmp_msg
                         history[-1][1] += rsp['content']
                         yield history
-                        app_global_para['last_turn_msg_id'].append(
-                            len(app_global_para['messages']))
-                        app_global_para['messages'].append(bot_msg)
+                        session_para['last_turn_msg_id'].append(
+                            len(session_para['messages']))
+                        session_para['messages'].append(bot_msg)
                         break
             else:
                 functions = [
@@ -297,44 +325,39 @@ def bot(history, upload_file, chosen_plug):
                 agent = ReAct(llm=llm)
                 for chunk in agent.run(user_request=history[-1][0],
                                        functions=functions,
-                                       history=app_global_para['messages']):
+                                       history=session_para['messages'],
+                                       session_id=request.session_hash):
                     history[-1][1] += chunk
                     yield history
                 yield history
 
                 message = {'role': 'user', 'content': history[-1][0]}
-                app_global_para['last_turn_msg_id'].append(
-                    len(app_global_para['messages']))
-                app_global_para['messages'].append(message)
+                session_para['last_turn_msg_id'].append(
+                    len(session_para['messages']))
+                session_para['messages'].append(message)
                 rsp_message = {'role': 'assistant', 'content': history[-1][1]}
-                app_global_para['last_turn_msg_id'].append(
-                    len(app_global_para['messages']))
-                app_global_para['messages'].append(rsp_message)
+                session_para['last_turn_msg_id'].append(
+                    len(session_para['messages']))
+                session_para['messages'].append(rsp_message)
 
         else:
-            lines = []
-            if not os.path.exists(app_global_para['cache_file']):
-                _ref = ''
+            lines = read_records(times=session_para['time'], checked=True)
+            if lines:
+                _ref_list = mem.get(
+                    history[-1][0],
+                    lines,
+                    llm=llm,
+                    stream=True,
+                    max_token=server_config.server.max_ref_token,
+                    global_rank=True,
+                )
+                _ref = '\n'.join(
+                    json.dumps(x, ensure_ascii=False) for x in _ref_list)
             else:
-                for line in jsonlines.open(app_global_para['cache_file']):
-                    if (app_global_para['time'][0] <= line['time'] <=
-                            app_global_para['time'][1]) and line['checked']:
-                        lines.append(line)
-                if lines:
-                    _ref_list = mem.get(
-                        history[-1][0],
-                        lines,
-                        llm=llm,
-                        stream=True,
-                        max_token=server_config.server.max_ref_token,
-                    )
-                    _ref = '\n'.join(
-                        json.dumps(x, ensure_ascii=False) for x in _ref_list)
-                else:
-                    _ref = ''
-                    gr.Warning(
-                        'No reference materials selected, Qwen will answer directly'
-                    )
+                _ref = ''
+                gr.Warning(
+                    'No reference materials selected, Qwen will answer directly'
+                )
 
             agent = RetrievalQA(llm=llm, stream=True)
             response = agent.run(user_request=history[-1][0], ref_doc=_ref)
@@ -345,17 +368,53 @@ def bot(history, upload_file, chosen_plug):
 
             # append message
             message = {'role': 'user', 'content': history[-1][0]}
-            app_global_para['last_turn_msg_id'].append(
-                len(app_global_para['messages']))
-            app_global_para['messages'].append(message)
+            session_para['last_turn_msg_id'].append(
+                len(session_para['messages']))
+            session_para['messages'].append(message)
 
             message = {'role': 'assistant', 'content': history[-1][1]}
-            app_global_para['last_turn_msg_id'].append(
-                len(app_global_para['messages']))
-            app_global_para['messages'].append(message)
+            session_para['last_turn_msg_id'].append(
+                len(session_para['messages']))
+            session_para['messages'].append(message)
+
+
+def _asking_anew(fn):
+    """Wraps a handler of an Again button to ask the LLM for a new answer.
+
+    Otherwise the same question would be answered from the cache again.
+    """
+
+    def _bypass_cache():
+        if isinstance(llm, CachedChatModel):
+            return llm.bypass()
+        return contextlib.nullcontext()
+
+    if inspect.isasyncgenfunction(fn):
+
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            with _bypass_cache():
+                async for update in fn(*args, **kwargs):
+                    yield update
 
+        return async_wrapper
 
-def generate(context):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _bypass_cache():
+            yield from fn(*args, **kwargs)
+
+    return wrapper
+
+
+# Wrapped inside coalesce_updates, so that the whole handler runs bypassing
+# the cache, in the thread or task that coalesce_updates runs it in.
+bot_again = coalesce_updates(_asking_anew(bot.__wrapped__))
+pure_bot_again = coalesce_updates(_asking_anew(pure_bot.__wrapped__))
+
+
+@coalesce_updates
+def generate(context, session_para, request: gr.Request):
     sp_query = get_last_one_line_context(context)
     res = ''
     if CODE_FLAG in sp_query:  # router to code interpreter
@@ -370,14 +429,16 @@ def generate(context):
             if x['name_for_model'] == 'code_interpreter'
         ]
         if llm.support_function_calling():
-            response = FunctionCalling(llm=llm).run(sp_query,
-                                                    functions=functions)
+            response = FunctionCalling(llm=llm).run(
+                sp_query, functions=functions, session_id=request.session_hash)
             for chunk in response:
                 res += chunk
                 yield res
         else:
             agent = ReAct(llm=llm)
-            for chunk in agent.run(user_request=sp_query, functions=functions):
+            for chunk in agent.run(user_request=sp_query,
+                                   functions=functions,
+                                   session_id=request.session_hash):
                 res += chunk
                 yield res
             yield res
@@ -385,24 +446,21 @@ def generate(context):
         sp_query = sp_query.split(PLUGIN_FLAG)[-1]
         functions = list_of_all_functions
         if llm.support_function_calling():
-            response = FunctionCalling(llm=llm).run(sp_query,
-                                                    functions=functions)
+            response = FunctionCalling(llm=llm).run(
+                sp_query, functions=functions, session_id=request.session_hash)
             for chunk in response:
                 res += chunk
                 yield res
         else:
             agent = ReAct(llm=llm)
-            for chunk in agent.run(user_request=sp_query, functions=functions):
+            for chunk in agent.run(user_request=sp_query,
+                                   functions=functions,
+                                   session_id=request.session_hash):
                 res += chunk
                 yield res
             yield res
     else:  # router to continue writing
-        lines = []
-        if os.path.exists(app_global_para['cache_file']):
-            for line in jsonlines.open(app_global_para['cache_file']):
-                if (app_global_para['time'][0] <= line['time'] <=
-                        app_global_para['time'][1]) and line['checked']:
-                    lines.append(line)
+        lines = read_records(times=session_para['time'], checked=True)
         if lines:
             res += '\n========================= \n'
             yield res
@@ -417,7 +475,8 @@ def generate(context):
                                 lines,
                                 llm=llm,
                                 stream=True,
-                                max_token=server_config.server.max_ref_token)
+                                max_token=server_config.server.max_ref_token,
+                                global_rank=True)
             _ref = '\n'.join(
                 json.dumps(x, ensure_ascii=False) for x in _ref_list)
             res += _ref
@@ -463,6 +522,7 @@ def format_generate(edit, context):
 
 
 with gr.Blocks(css=css, theme='soft') as demo:
+    session_para = gr.State(SESSION_PARA)
     title = gr.Markdown('Qwen Agent: BrowserQwen', elem_classes='title')
     desc = gr.Markdown(
         'This is the editing workstation of BrowserQwen, where Qwen has collected the browsing history. Qwen can assist you in completing your creative work!',
@@ -547,7 +607,8 @@ with gr.Blocks(css=css, theme='soft') as demo:
                         ],
                         show_copy_button=True,
                     )
-        clk_ctn_bt = ctn_bt.click(generate, edit_area, cmd_area)
+        clk_ctn_bt = ctn_bt.click(generate, [edit_area, session_para],
+                                  cmd_area)
         clk_ctn_bt.then(format_generate, [edit_area, cmd_area], edit_area)
 
         edit_area_change = edit_area.change(layout_to_right, edit_area,
@@ -625,9 +686,11 @@ with gr.Blocks(css=css, theme='soft') as demo:
                         label='The uploaded file is displayed here')
 
             txt_msg = chat_txt.submit(
-                add_text, [chatbot, chat_txt], [chatbot, chat_txt],
-                queue=False).then(bot, [chatbot, hidden_file_path, plug_bt],
-                                  chatbot)
+                add_text, [chatbot, chat_txt, session_para],
+                [chatbot, chat_txt],
+                queue=False).then(
+                    bot, [chatbot, hidden_file_path, plug_bt, session_para],
+                    chatbot)
             txt_msg.then(lambda: gr.update(interactive=True),
                          None, [chat_txt],
                          queue=False)
@@ -637,27 +700,30 @@ with gr.Blocks(css=css, theme='soft') as demo:
             # (None, None, None, cancels=[txt_msg], queue=False).then
             re_txt_msg = (chat_re_bt.click(
                 rm_text, [chatbot], [chatbot, chat_txt],
-                queue=False).then(chat_clear_last, None, None).then(
-                    bot, [chatbot, hidden_file_path, plug_bt], chatbot))
+                queue=False).then(chat_clear_last, session_para, None).then(
+                    bot_again,
+                    [chatbot, hidden_file_path, plug_bt, session_para],
+                    chatbot))
             re_txt_msg.then(lambda: gr.update(interactive=True),
                             None, [chat_txt],
                             queue=False)
 
-            file_msg = file_btn.upload(add_file, [file_btn, plug_bt],
+            file_msg = file_btn.upload(add_file,
+                                       [file_btn, plug_bt, session_para],
                                        [hidden_file_path],
                                        queue=False)
-            file_msg.then(update_browser_list, None,
+            file_msg.then(update_browser_list, session_para,
                           browser_list).then(lambda: None,
                                              None,
                                              None,
                                              _js=f'() => {{{js}}}')
 
             chat_clr_bt.click(chat_clear,
-                              None, [chatbot, hidden_file_path],
+                              session_para, [chatbot, hidden_file_path],
                               queue=False)
             # re_bt.click(re_bot, chatbot, chatbot)
             chat_stop_bt.click(chat_clear_last,
-                               None,
+                               session_para,
                                None,
                                cancels=[txt_msg, re_txt_msg],
                                queue=False)
@@ -704,7 +770,7 @@ with gr.Blocks(css=css, theme='soft') as demo:
             re_txt_msg = chat_re_bt.click(
                 rm_text, [pure_chatbot], [pure_chatbot, chat_txt],
                 queue=False).then(
-                    pure_bot, pure_chatbot, pure_chatbot)
+                    pure_bot_again, pure_chatbot, pure_chatbot)
             re_txt_msg.then(lambda: gr.update(interactive=True),
                             None, [chat_txt],
                             queue=False)
@@ -714,37 +780,53 @@ with gr.Blocks(css=css, theme='soft') as demo:
                               queue=False)
 
             chat_stop_bt.click(chat_clear_last,
-                               None,
+                               session_para,
                                None,
                                cancels=[txt_msg, re_txt_msg],
                                queue=False)
 
-    date1.change(update_app_global_para, [date1, date2],
-                 None).then(update_browser_list, None,
+    date1.change(update_session_para, [date1, date2, session_para],
+                 None).then(update_browser_list, session_para,
                             browser_list).then(lambda: None,
                                                None,
                                                None,
                                                _js=f'() => {{{js}}}').then(
-                                                   chat_clear, None,
+                                                   chat_clear, session_para,
                                                    [chatbot, hidden_file_path])
-    date2.change(update_app_global_para, [date1, date2],
-                 None).then(update_browser_list, None,
+    date2.change(update_session_para, [date1, date2, session_para],
+                 None).then(update_browser_list, session_para,
                             browser_list).then(lambda: None,
                                                None,
                                                None,
                                                _js=f'() => {{{js}}}').then(
-                                                   chat_clear, None,
+                                                   chat_clear, session_para,
                                                    [chatbot, hidden_file_path])
 
-    demo.load(update_app_global_para, [date1, date2],
+    demo.load(update_session_para, [date1, date2, session_para],
               None).then(refresh_date, None, [date1, date2]).then(
-                  update_browser_list, None,
+                  update_browser_list, session_para,
                   browser_list).then(lambda: None,
                                      None,
                                      None,
                                      _js=f'() => {{{js}}}').then(
-                                         chat_clear, None,
+                                         chat_clear, session_para,
                                          [chatbot, hidden_file_path])
 
-demo.queue().launch(server_name=server_config.server.server_host,
-                    server_port=server_config.server.workstation_port)
+# Only when run, not when imported by the worker processes that parse PDFs.
+if __name__ == '__main__':
+    prewarm_kernels()
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    threading.Thread(target=initialize_jieba, daemon=True).start()
+
+    # Code interpreter sessions run on their own kernels, and the state of the
+    # conversations is per session, hence the sessions can run concurrently.
+    app, _, _ = demo.queue(concurrency_count=MAX_KERNELS).launch(
+        server_name=server_config.server.server_host,
+        server_port=server_config.server.workstation_port,
+        prevent_thread_lock=True)
+    # Pure Chat streams from the LLM over a session of the server's loop.
+    app.add_event_handler('shutdown', http_pool.close_session)
+    try:
+        demo.block_thread()
+    finally:
+        demo.close()  # also on SIGTERM, so that the server shuts down
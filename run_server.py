@@ -9,6 +9,7 @@ from pathlib import Path
 
 from qwen_agent.log import logger
 from qwen_agent.utils.utils import get_local_ip
+from qwen_server.record_store import RecordStore
 from qwen_server.schema import GlobalConfig
 
 
@@ -93,6 +94,13 @@ def main():
     os.makedirs(server_config.path.cache_root, exist_ok=True)
     os.makedirs(server_config.path.download_root, exist_ok=True)
 
+    store = RecordStore(
+        os.path.join(server_config.path.cache_root, 'browse.db'))
+    num_migrated = store.migrate_from_jsonl(
+        os.path.join(server_config.path.cache_root, 'browse.jsonl'))
+    if num_migrated:
+        logger.info(f'Migrated {num_migrated} records from browse.jsonl')
+
     os.makedirs(server_config.path.code_interpreter_ws, exist_ok=True)
     code_interpreter_work_dir = str(
         Path(__file__).resolve().parent /
@@ -106,6 +114,10 @@ def main():
     static_url = f'http://{static_url}:{server_config.server.fast_api_port}/static'
     os.environ['M6_CODE_INTERPRETER_STATIC_URL'] = static_url
 
+    # Share the detected capabilities of the llm between the servers.
+    os.environ['QWEN_AGENT_CAPABILITY_CACHE'] = os.path.join(
+        server_config.path.cache_root, 'capabilities.json')
+
     _fix_secure_write_for_code_interpreter(
         server_config.path.code_interpreter_ws)
 
@@ -0,0 +1,93 @@
+import importlib
+
+import pytest
+
+from qwen_agent.utils import doc_parser
+
+# In the order _get_html_to_text tries them, the fastest first.
+BACKENDS = [
+    ('selectolax.lexbor', doc_parser._html_to_text_selectolax),
+    ('lxml.html', doc_parser._html_to_text_lxml),
+    ('html.parser', doc_parser._html_to_text_stdlib),
+]
+
+PAGES = {
+    'article':
+    '<html><head><title> A page </title><style>p {}</style></head><body>'
+    '<nav><a href="/">Home</a></nav><h1>Heading</h1>'
+    '<p>First <b>bold</b> paragraph.</p><script>var x = 1;</script>'
+    '<ul><li>one</li><li>two</li></ul><p>Tail &amp; more</p>'
+    '<footer>Copyright</footer></body></html>',
+    'svg title':
+    '<html><head><title>Page</title></head><body>'
+    '<button><svg><title>Close icon</title></svg></button>'
+    '<p>Text</p></body></html>',
+    'svg title only':
+    '<html><body><svg><title>Close icon</title></svg><p>Text</p>'
+    '</body></html>',
+    'no head':
+    '<title>Title</title><div>Line<br>break</div>',
+    'whitespace':
+    ' \n\t',
+    'comment':
+    '<!-- nothing here -->',
+    'empty':
+    '',
+}
+
+
+def _parse(monkeypatch, backend, html):
+    monkeypatch.setattr(doc_parser, '_get_html_to_text', lambda: backend)
+    return doc_parser.parse_html(html, source='url')
+
+
+@pytest.mark.parametrize('name', list(PAGES))
+@pytest.mark.parametrize('module, backend',
+                         BACKENDS,
+                         ids=[x for x, _ in BACKENDS])
+def test_same_as_stdlib(monkeypatch, module, backend, name):
+    pytest.importorskip(module)
+    expected = _parse(monkeypatch, doc_parser._html_to_text_stdlib,
+                      PAGES[name])
+    assert _parse(monkeypatch, backend, PAGES[name]) == expected
+
+
+def test_stdlib():
+    to_text = doc_parser._html_to_text_stdlib
+    title, text = to_text(PAGES['article'])
+    assert title == 'A page'
+    assert text.split() == [
+        'Heading', 'First', 'bold', 'paragraph.', 'one', 'two', 'Tail', '&',
+        'more'
+    ]
+    assert to_text(PAGES['svg title']) == ('Page', '\nText\n')
+    assert to_text(PAGES['svg title only'])[0] == ''
+    assert to_text(PAGES['comment']) == ('', '')
+
+
+def test_pages(monkeypatch):
+    pages = _parse(monkeypatch, doc_parser._html_to_text_stdlib,
+                   PAGES['article'])
+    assert pages == [{
+        'page_content':
+        'Heading\nFirst bold paragraph.\none\ntwo\nTail & more',
+        'metadata': {
+            'source': 'url',
+            'title': 'A page'
+        }
+    }]
+    assert _parse(monkeypatch, doc_parser._html_to_text_stdlib, '') == []
+
+
+def test_fastest_backend_installed():
+    for module, expected in BACKENDS:
+        try:
+            importlib.import_module(module)
+            break
+        except ImportError:
+            continue
+    doc_parser._get_html_to_text.cache_clear()
+    try:
+        assert doc_parser._get_html_to_text() is expected
+    finally:
+        doc_parser._get_html_to_text.cache_clear()